@@ -0,0 +1,201 @@
+"""
+Benchmark cases. Each case is built once per payload size and returns
+the callable that is timed.
+"""
+from decimal import Decimal
+import datetime
+
+from utils.web_platform.managers import BaseManager
+from utils.web_platform.mapping import BaseMapping, MappingResourceField
+from utils.web_platform import query_parser
+from utils.web_platform.query_parser import decode_filter_data, decode_order_data
+from utils.web_platform.services import BaseService
+from utils.web_platform.validation import validate_fields
+from utils.web_platform.webapi import BaseWebApi, JsonEncoder
+
+from utils.web_platform.benchmarks.models import BenchGroup, BenchItem
+
+SIZES = {
+    'small': 10,
+    'medium': 1000,
+    'huge': 10000,
+}
+
+FIELDS = ['id', 'title', 'description', 'price', 'quantity', 'is_active', 'created_at']
+
+
+class GroupMapping(BaseMapping):
+    class Meta:
+        fields = {
+            "id": "id",
+            "name": "name",
+            "code": "code",
+        }
+
+
+class ItemMapping(BaseMapping):
+    group = MappingResourceField(GroupMapping)
+
+    class Meta:
+        fields = {
+            "id": "id",
+            "title": "title",
+            "description": "description",
+            "price": "price",
+            "quantity": "quantity",
+            "isActive": "is_active",
+            "createdAt": "created_at",
+        }
+        resource_fields = {
+            "group": "group",
+        }
+
+
+class ItemManager(BaseManager):
+    def __init__(self):
+        super(ItemManager, self).__init__(FIELDS, (('group', ['id', 'name', 'code'], 'id'),))
+        self.objects = BenchItem.objects.all()
+
+
+VALIDATION_OPTIONS = {
+    'title': {'required': True, 'min_length': 1, 'max_length': 200},
+    'description': {'required': False, 'max_length': 2000},
+    'price': {'required': True, 'type': 'decimal'},
+    'quantity': {'required': True, 'type': 'integer', 'min_value': 0},
+    'is_active': {'required': False, 'type': 'bool', 'default': '1'},
+    'email': {'required': True, 'validation_type': 'email'},
+}
+
+
+def create_tables():
+    from django.db import connection
+    with connection.schema_editor() as editor:
+        editor.create_model(BenchGroup)
+        editor.create_model(BenchItem)
+
+
+def populate(count):
+    BenchItem.objects.all().delete()
+    BenchGroup.objects.all().delete()
+    BenchGroup.objects.bulk_create([BenchGroup(name="Group %s" % i, code="G%s" % i) for i in range(10)])
+    groups = list(BenchGroup.objects.all())
+    created_at = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    BenchItem.objects.bulk_create([
+        BenchItem(title="Item %s" % i, description="Description of item %s" % i, price=Decimal('9.99'),
+                  quantity=i, is_active=bool(i % 2), created_at=created_at, group=groups[i % len(groups)])
+        for i in range(count)
+    ], batch_size=500)
+
+
+def make_rows(count):
+    created_at = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    return [{
+        'id': i,
+        'title': "Item %s" % i,
+        'description': "Description of item %s" % i,
+        'price': Decimal('9.99'),
+        'quantity': i,
+        'is_active': bool(i % 2),
+        'created_at': created_at,
+        'group': {'id': i % 10, 'name': "Group %s" % (i % 10), 'code': "G%s" % (i % 10)},
+    } for i in range(count)]
+
+
+def mapping_encode(count):
+    rows = make_rows(count)
+    return lambda: ItemMapping(None).encode(rows)
+
+
+def webapi_mapping_data(count):
+    rows = make_rows(count)
+    api = BaseWebApi()
+    return lambda: api.mapping_data(rows)
+
+
+def validation_validate_fields(count):
+    inputs = [{
+        'title': "Item %s" % i,
+        'description': "Description of item %s" % i,
+        'price': '9.99',
+        'quantity': str(i),
+        'email': "user%s@example.com" % i,
+    } for i in range(count)]
+
+    def run():
+        for item in inputs:
+            validate_fields(dict(item), VALIDATION_OPTIONS)
+    return run
+
+
+def make_filter(count):
+    return ",".join("field%s:%s" % (i % 20, "|".join(str(v) for v in range(i % 5 + 1))) for i in range(count))
+
+
+def query_parser_decode_filter(count):
+    """
+    repeated filter, served by the plan cache after the first run
+    """
+    raw = make_filter(count)
+    return lambda: decode_filter_data(raw)
+
+
+def query_parser_decode_filter_cold(count):
+    """
+    every run parses the filter
+    """
+    raw = make_filter(count)
+
+    def run():
+        query_parser._filter_cache.clear()
+        return decode_filter_data(raw)
+    return run
+
+
+def query_parser_decode_order(count):
+    params = dict(("field_%s" % i, "field%s" % i) for i in range(20))
+    raw = "|".join(("-" if i % 2 else "") + "field%s" % (i % 20) for i in range(count))
+    return lambda: decode_order_data(raw, **params)
+
+
+def manager_to_data(count):
+    populate(count)
+    return lambda: list(ItemManager().to_data())
+
+
+def manager_to_columns(count):
+    populate(count)
+    return lambda: ItemMapping(None).encode(ItemManager().to_data(layout='columns'))
+
+
+def service_model_to_dict(count):
+    populate(count)
+    instances = list(BenchItem.objects.all())
+    model_to_dict = BaseService.model_to_dict
+    return lambda: [model_to_dict(instance) for instance in instances]
+
+
+def webapi_json_response(count):
+    rows = ItemMapping(None).encode(make_rows(count))
+    api = BaseWebApi()
+    return lambda: api.json_response(rows)
+
+
+def mapping_encode_json(count):
+    rows = make_rows(count)
+    encode = JsonEncoder(sort_keys=True, ensure_ascii=False).encode
+    return lambda: ItemMapping(None).encode_json(rows, encode)
+
+
+CASES = [
+    ('mapping.encode', mapping_encode),
+    ('webapi.mapping_data', webapi_mapping_data),
+    ('validation.validate_fields', validation_validate_fields),
+    ('query_parser.decode_filter_data', query_parser_decode_filter),
+    ('query_parser.decode_filter_data_cold', query_parser_decode_filter_cold),
+    ('query_parser.decode_order_data', query_parser_decode_order),
+    ('managers.to_data', manager_to_data),
+    ('managers.to_columns', manager_to_columns),
+    ('services.model_to_dict', service_model_to_dict),
+    ('webapi.json_response', webapi_json_response),
+    ('mapping.encode_json', mapping_encode_json),
+]
@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class BenchGroup(models.Model):
+    name = models.CharField(max_length=100)
+    code = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'benchmarks'
+
+
+class BenchItem(models.Model):
+    title = models.CharField(max_length=200)
+    description = models.TextField(blank=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.IntegerField(default=0)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField()
+    group = models.ForeignKey(BenchGroup, null=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        app_label = 'benchmarks'
@@ -0,0 +1,152 @@
+"""
+Run the micro benchmarks.
+
+    python benchmarks/run.py                      # print timings
+    python benchmarks/run.py --save               # store them as the new baseline
+    python benchmarks/run.py --compare            # fail if slower than baseline
+    python benchmarks/run.py --compare --threshold 0.1 --size medium --case mapping
+    python benchmarks/run.py --case startup       # cold import of the package in a new interpreter
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+import types
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, 'baseline.json')
+
+
+PACKAGE_MODULES = ['webapi', 'managers', 'mapping', 'validation', 'services', 'permissions', 'query_parser']
+
+
+def setup():
+    """
+    make the package importable as `utils.web_platform` when the suite runs
+    from a plain checkout and set up django with the in-memory settings
+    """
+    try:
+        import utils.web_platform  # noqa
+    except ImportError:
+        utils = types.ModuleType('utils')
+        utils.__path__ = []
+        package = types.ModuleType('utils.web_platform')
+        package.__path__ = [os.path.dirname(BASE_DIR)]
+        utils.web_platform = package
+        sys.modules['utils'] = utils
+        sys.modules['utils.web_platform'] = package
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'utils.web_platform.benchmarks.settings')
+    import django
+    django.setup()
+
+
+def startup(target):
+    """
+    body of the startup cases, runs in a new interpreter
+    """
+    setup()
+    if target == 'package':
+        for name in PACKAGE_MODULES:
+            __import__('utils.web_platform.%s' % name)
+
+
+def startup_case(target):
+    def make_case(count):
+        command = [sys.executable, os.path.abspath(__file__), '--startup', target]
+        return lambda: subprocess.check_call(command)
+    # the payload size doesn't matter for a cold start
+    make_case.sizes = ('small',)
+    return make_case
+
+
+STARTUP_CASES = [
+    ('startup.django', startup_case('django')),
+    ('startup.package', startup_case('package')),
+]
+
+
+def bootstrap():
+    setup()
+    from utils.web_platform.benchmarks import cases
+    cases.create_tables()
+    return cases
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--case', action='append', default=[], help="run only cases containing this name")
+    parser.add_argument('--size', action='append', default=[], help="small, medium or huge")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help="write results to the baseline file")
+    parser.add_argument('--compare', action='store_true', help="compare with the baseline file")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed slowdown against the baseline, 0.2 = 20%%")
+    parser.add_argument('--startup', choices=['django', 'package'], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        startup(args.startup)
+        return 0
+
+    cases = bootstrap()
+    sizes = args.size or list(cases.SIZES.keys())
+    baseline = load_baseline(args.baseline) if args.compare else {}
+
+    results = {}
+    regressions = []
+    for name, make_case in cases.CASES + STARTUP_CASES:
+        if args.case and not any(c in name for c in args.case):
+            continue
+        for size in sizes:
+            if size not in getattr(make_case, 'sizes', (size,)):
+                continue
+            key = "%s[%s]" % (name, size)
+            elapsed = measure(make_case(cases.SIZES[size]), args.repeat)
+            results[key] = elapsed
+            line = "%-45s %12.3f ms" % (key, elapsed * 1000)
+            if key in baseline:
+                ratio = elapsed / baseline[key]
+                line += "  x%.2f" % ratio
+                if ratio > 1 + args.threshold:
+                    line += "  REGRESSION"
+                    regressions.append(key)
+            print(line)
+
+    if args.save:
+        stored = load_baseline(args.baseline)
+        stored.update(results)
+        save_baseline(args.baseline, stored)
+        print("baseline saved to %s" % args.baseline)
+
+    if regressions:
+        print("%s case(s) slower than baseline by more than %d%%: %s"
+              % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+"""
+Minimal offline settings for the benchmark suite (in-memory SQLite).
+"""
+SECRET_KEY = 'web-api-benchmarks'
+DEBUG = False
+USE_TZ = False
+USE_I18N = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'utils.web_platform.benchmarks',
+]
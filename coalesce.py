@@ -0,0 +1,100 @@
+"""
+Single-flight coalescing of identical concurrent GET requests.
+
+    WEB_API_COALESCE = True               # default False, Meta.coalesce per resource
+    WEB_API_COALESCE_TIMEOUT = 5          # seconds a request waits for the leader
+
+While a GET runs, other GETs of the same view with the same query, Accept
+header and auth scope (user, Authorization/Key header, session) wait for it
+and get a copy of its response instead of running the view. A follower runs
+the view itself when the leader doesn't answer with 2xx/3xx, answers with a
+response that can't be shared (streaming, cookies) or doesn't finish in time.
+Followers don't get the headers about the leader's request (Server-Timing,
+X-Query-Count, X-Query-Time).
+Coalescing is per process, between the threads of a worker.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.encoding import force_bytes
+
+COALESCE_TIMEOUT = 5
+# headers about the leader's own request (timings, query profile), followers don't get them
+REQUEST_HEADERS = ('server-timing', 'x-query-count', 'x-query-time', 'date', 'set-cookie')
+
+_flights = {}
+_lock = threading.Lock()
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.shared = None
+
+
+def is_enabled(enabled=None):
+    if enabled is None:
+        return getattr(settings, 'WEB_API_COALESCE', False)
+    return enabled
+
+
+def get_scope(request):
+    user = getattr(request, 'user', None)
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    return (user_id, request.META.get('HTTP_AUTHORIZATION'), request.META.get('HTTP_KEY'),
+            request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+
+
+def make_key(request, view):
+    source = repr((view, request.path, sorted(request.GET.lists()), request.META.get('HTTP_ACCEPT'),
+                   get_scope(request)))
+    return hashlib.md5(force_bytes(source)).hexdigest()
+
+
+def freeze(response):
+    """
+    (status, content, headers) of a 2xx/3xx response the followers may get, None when it can't be shared
+    """
+    if response.streaming or not 200 <= response.status_code < 400 or response.cookies:
+        return None
+    headers = [(header, value) for header, value in response.items() if header.lower() not in REQUEST_HEADERS]
+    return response.status_code, response.content, headers
+
+
+def thaw(shared):
+    status, content, headers = shared
+    response = HttpResponse(content, status=status)
+    for header, value in headers:
+        response[header] = value
+    if settings.DEBUG:
+        response['X-Coalesced'] = '1'
+    return response
+
+
+def run(key, func, timeout=None):
+    """
+    func() for the first caller of `key`, the callers meanwhile get a copy of its response
+    """
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if leader:
+        response = None
+        try:
+            response = func()
+            return response
+        finally:
+            if response is not None:
+                flight.shared = freeze(response)
+            with _lock:
+                _flights.pop(key, None)
+            flight.done.set()
+    if timeout is None:
+        timeout = getattr(settings, 'WEB_API_COALESCE_TIMEOUT', COALESCE_TIMEOUT)
+    if flight.done.wait(timeout) and flight.shared is not None:
+        return thaw(flight.shared)
+    return func()
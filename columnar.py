@@ -0,0 +1,109 @@
+"""
+Columnar envelope for large tabular lists.
+
+    {"fields": ["id", "title", "group.name"], "columns": [[1, 2], ["a", "b"], ["g1", "g2"]]}
+    {"fields": ["id", "title", "group.name"], "rows": [[1, "a", "g1"], [2, "b", "g2"]]}
+
+The client asks for it with `?layout=columns` (or `rows`) or with the
+`application/vnd.columnar+json` media type in the Accept header,
+`;layout=rows` selects the rows layout.
+Rows are the tuples of `values_list`, no dict is built per row.
+"""
+from operator import itemgetter
+
+import six
+
+COLUMNS = 'columns'
+ROWS = 'rows'
+LAYOUTS = (COLUMNS, ROWS)
+MEDIA_TYPE = 'application/vnd.columnar+json'
+PATH_SEPARATOR = '__'
+NAME_SEPARATOR = '.'
+
+
+class Columnar(object):
+    """
+    fields - orm paths of the values ('title', 'group__name'), rows - sequence of tuples
+    """
+
+    def __init__(self, fields, rows, layout=COLUMNS):
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown layout '%s'" % layout)
+        self.fields = list(fields)
+        self.rows = rows
+        self.layout = layout
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        """
+        a slice of the rows keeps the layout, e.g. a page of BaseService.objects_to_paging
+        """
+        if isinstance(index, slice):
+            return Columnar(self.fields, self.rows[index], self.layout)
+        return dict(zip(self.fields, self.rows[index]))
+
+    def __iter__(self):
+        """
+        rows as dicts, for code that expects the to_data items
+        """
+        fields = self.fields
+        return (dict(zip(fields, row)) for row in self.rows)
+
+    def select(self, indexes, fields):
+        """
+        keep the values at `indexes` named by `fields`
+        """
+        indexes = list(indexes)
+        if indexes == list(range(len(self.fields))):
+            return Columnar(fields, self.rows, self.layout)
+        if not indexes:
+            return Columnar(fields, [() for row in self.rows], self.layout)
+        getter = itemgetter(*indexes)
+        if len(indexes) == 1:
+            rows = [(getter(row),) for row in self.rows]
+        else:
+            rows = [getter(row) for row in self.rows]
+        return Columnar(fields, rows, self.layout)
+
+    def rename(self, func):
+        return Columnar([NAME_SEPARATOR.join(func(bit) for bit in field.split(PATH_SEPARATOR))
+                         for field in self.fields], self.rows, self.layout)
+
+    def columns(self):
+        if not self.rows:
+            return [[] for field in self.fields]
+        return [list(column) for column in zip(*self.rows)]
+
+    def envelope(self):
+        if self.layout == ROWS:
+            return {'fields': self.fields, ROWS: [list(row) for row in self.rows]}
+        return {'fields': self.fields, COLUMNS: self.columns()}
+
+
+def parse_accept(accept):
+    """
+    layout requested by the Accept header or None
+    """
+    for media_range in accept.split(','):
+        bits = [bit.strip() for bit in media_range.split(';')]
+        if bits[0].lower() != MEDIA_TYPE:
+            continue
+        for param in bits[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'layout' and value.strip() in LAYOUTS:
+                return value.strip()
+        return COLUMNS
+    return None
+
+
+def get_layout(request, param='layout'):
+    """
+    `param` of the query wins over the Accept header
+    """
+    data = getattr(request, 'data', None) or {}
+    value = data.get(param) if isinstance(data, dict) else None
+    if isinstance(value, six.string_types) and value in LAYOUTS:
+        return value
+    return parse_accept(request.META.get('HTTP_ACCEPT', ''))
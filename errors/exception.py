@@ -139,11 +139,14 @@ class NotAcceptable(APIException):
     default_detail = _('Could not satisfy the request Accept header.')
 
     def __init__(self, detail=None, available_renderers=None):
-        if detail is not None:
-            self.detail = force_text(detail)
-        else:
-            self.detail = force_text(self.default_detail)
         self.available_renderers = available_renderers
+        super(NotAcceptable, self).__init__(detail)
+
+    def create_info(self, message=None):
+        self.info = super(NotAcceptable, self).create_info(message=message)
+        if self.available_renderers:
+            self.info['available'] = self.available_renderers
+        return self.info
 
 
 class UnsupportedMediaType(APIException):
@@ -151,12 +154,16 @@ class UnsupportedMediaType(APIException):
     default_detail = _('Unsupported media type "{media_type}" in request.')
 
     def __init__(self, media_type, detail=None):
-        if detail is not None:
-            self.detail = force_text(detail)
-        else:
-            self.detail = force_text(self.default_detail).format(
+        if detail is None:
+            detail = force_text(self.default_detail).format(
                 media_type=media_type
             )
+        super(UnsupportedMediaType, self).__init__(detail)
+
+
+class ServiceTimeout(APIException):
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_detail = _('Service timed out.')
 
 
 class Throttled(APIException):
@@ -0,0 +1,210 @@
+"""
+NDJSON and CSV export of list resources.
+
+    @response_mapping(UserMapping, mapping_path='data', export=True)
+    def users(self, request): ...
+
+    GET /users?f=...&o=...&export=csv&compress=gzip
+
+The view runs as usual with its filters and order. While it runs
+BaseManager.to_data returns ExportRows, read lazily with a server-side
+iterator. When the view returns them under mapping_path, the export reads
+them without the limit() of the view, other reads of the view (counts,
+side lookups, "top N" queries) are not changed. The total of the view isn't
+written to the file.
+Negotiation doesn't refuse the export, whatever the Accept header. The rows go through the mapping and are written
+in chunks of settings.WEB_API_EXPORT_CHUNK_SIZE (default 1000) rows, so
+the memory doesn't grow with the size of the export.
+"""
+from contextlib import contextmanager
+import csv
+import json
+import threading
+import zlib
+
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.http import StreamingHttpResponse
+import six
+
+from utils.web_platform.mapping import batch_context, BatchContext
+from utils.web_platform.renderers import to_primitive
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+CONTENT_TYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv; charset=utf-8',
+}
+GZIP = 'gzip'
+CHUNK_SIZE = 1000
+
+_local = threading.local()
+
+
+def get_chunk_size():
+    return getattr(settings, 'WEB_API_EXPORT_CHUNK_SIZE', CHUNK_SIZE)
+
+
+@contextmanager
+def exporting(format):
+    """
+    reads of the managers inside the block are for an export
+    """
+    _local.format = format
+    try:
+        yield
+    finally:
+        _local.format = None
+
+
+def is_exporting():
+    return getattr(_local, 'format', None) is not None
+
+
+def get_format(request, param='export', formats=FORMATS):
+    value = request.GET.get(param)
+    return value if value in formats else None
+
+
+class ExportRows(object):
+    """
+    rows of BaseManager.to_data while exporting, convert(values) of each row of `objects`
+    """
+
+    def __init__(self, objects, convert):
+        self.objects = objects
+        self.convert = convert
+
+    def __iter__(self):
+        return six.moves.map(self.convert, self.objects.iterator(chunk_size=get_chunk_size()))
+
+    def unpaged(self):
+        """
+        the same rows without the slice of BaseManager.limit
+        """
+        objects = self.objects._chain()
+        objects.query.clear_limits()
+        return ExportRows(objects, self.convert)
+
+
+def unpaged(rows):
+    return rows.unpaged() if isinstance(rows, ExportRows) else rows
+
+
+def iter_chunks(items, size):
+    if isinstance(items, QuerySet):
+        items = items.iterator(chunk_size=size)
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_mapped(items, mapping, write, size):
+    """
+    write(item, prefetched) of every row, the resource loaders run once per chunk
+    """
+    for chunk in iter_chunks(items, size):
+        with batch_context(BatchContext()):
+            prefetched = mapping.prefetch(chunk) if mapping._meta.batch else None
+            yield [write(item, prefetched) for item in chunk]
+
+
+def ndjson_chunks(items, mapping, size, auto_encode=False):
+    encode = json.JSONEncoder(default=to_primitive, sort_keys=True, ensure_ascii=False).encode
+
+    def write(item, prefetched):
+        return encode(mapping.convert(item, auto_encode, prefetched)) + '\n'
+
+    for lines in iter_mapped(items, mapping, write, size):
+        yield ''.join(lines)
+
+
+def get_columns(mapping, prefix=''):
+    """
+    csv header, nested resources as 'resource.field'
+    """
+    columns = [prefix + name for name in sorted(mapping.encode_fields.values())]
+    for key, new_key in sorted(mapping.encode_resource_fields.items(), key=lambda item: item[1]):
+        resource = mapping.resources.get(key)
+        if resource is None:
+            columns.append(prefix + new_key)
+        else:
+            columns += get_columns(resource, prefix + new_key + '.')
+    return columns
+
+
+def get_cell(row, column):
+    value = row
+    for bit in column.split('.'):
+        if isinstance(value, list):
+            value = [item.get(bit) if isinstance(item, dict) else None for item in value]
+        elif isinstance(value, dict):
+            value = value.get(bit)
+        else:
+            return ''
+    if value is None:
+        return ''
+    if value is True or value is False:
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=to_primitive, sort_keys=True, ensure_ascii=False)
+    if isinstance(value, six.string_types + six.integer_types + (float,)):
+        return value
+    return to_primitive(value)
+
+
+class Echo(object):
+    def write(self, value):
+        return value
+
+
+def csv_chunks(items, mapping, size, auto_encode=False):
+    columns = get_columns(mapping)
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+
+    def write(item, prefetched):
+        row = mapping.convert(item, auto_encode, prefetched) or {}
+        return writer.writerow([get_cell(row, column) for column in columns])
+
+    for lines in iter_mapped(items, mapping, write, size):
+        yield ''.join(lines)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+WRITERS = {
+    NDJSON: ndjson_chunks,
+    CSV: csv_chunks,
+}
+
+
+def export_response(items, mapping, format, filename='export', compress=None, auto_encode=False):
+    """
+    StreamingHttpResponse with the rows of `items` (list, generator or queryset) mapped by `mapping`
+    """
+    rows = [] if items is None else [items] if isinstance(items, dict) else items
+    chunks = WRITERS[format](rows, mapping, get_chunk_size(), auto_encode)
+    filename = "%s.%s" % (filename, format)
+    content_type = CONTENT_TYPES[format]
+    if compress == GZIP:
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
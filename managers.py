@@ -1,13 +1,36 @@
 from django.utils import six
-from django.db import connection
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router, transaction, DatabaseError, IntegrityError
+from django.core.exceptions import EmptyResultSet
 from django.db.models import Q
+from django.utils.encoding import force_text
+from collections import namedtuple
 import copy
-from pymongo import MongoClient
+from functools import reduce
+
+from utils.web_platform import export, query_cache, routing, timing
+from utils.web_platform.columnar import Columnar
+from utils.web_platform.query_parser import large_in
+from utils.web_platform.search import get_search_backend, IContainsSearchBackend
 
 
 class ManagerOptions(object):
     db_name = None
     table_name = None
+    search_backend = None
+    search_config = 'simple'
+    search_table = None
+    search_rank = True
+    # fields kept by `only` whatever the client asks for
+    required_fields = ()
+    # None - settings.WEB_API_READ_REPLICAS, () - read from the primary
+    read_replicas = None
+    replica_strategy = None
+    # rows per statement and transaction of the bulk writes
+    batch_size = 500
+    # models (or 'app_label.model' labels) whose save/delete drop the .cached() results,
+    # the queryset model is always included
+    cache_models = ()
 
     def __new__(cls, meta=None):
         overrides = {}
@@ -26,10 +49,14 @@ class DeclarativeMetaclass(type):
         new_class = super(DeclarativeMetaclass, cls).__new__(cls, name, bases, attrs)
         opts = getattr(new_class, 'Meta', None)
         new_class._meta = ManagerOptions(opts)
+        query_cache.watch(new_class._meta.cache_models)
         return new_class
 
 
 class BaseManager(six.with_metaclass(DeclarativeMetaclass)):
+    # {read key: (sql, params)} shared by the reads of one QueryChain
+    compiled = None
+
     def __init__(self, fields=None, related_fields=None):
         self.objects = None
         self.fields = fields or []
@@ -38,14 +65,65 @@ class BaseManager(six.with_metaclass(DeclarativeMetaclass)):
 
     def clear(self):
         self.objects = None
+        self.cache_ttl = None
         return self
 
+    def cached(self, ttl=60):
+        """
+        keep the results of the following reads for `ttl` seconds, see query_cache
+        """
+        self.cache_ttl = ttl
+        return self
+
+    def get_cache_models(self):
+        return query_cache.watch(list(self._meta.cache_models) + [self.objects.model])
+
+    def chain(self):
+        """
+        immutable QueryChain starting from the current state of the manager
+        """
+        return QueryChain(self)
+
+    def compile(self, key, objects):
+        """
+        (sql, params) of `objects`, None for a query that can't match anything,
+        memoized in `compiled` by the key and the database alias when the manager reads for a QueryChain
+        """
+        using = objects.db
+        if self.compiled is None:
+            return self.get_sql(objects, using)
+        memo_key = (key, using)
+        if memo_key not in self.compiled:
+            self.compiled[memo_key] = self.get_sql(objects, using)
+        return self.compiled[memo_key]
+
+    @staticmethod
+    def get_sql(objects, using):
+        try:
+            return objects.query.get_compiler(using=using).as_sql()
+        except EmptyResultSet:
+            return None
+
+    def fetch(self, key, objects, func):
+        """
+        func() or its cached result when `cached` is on, the cache key is the sql of `objects`
+        """
+        if not self.cache_ttl:
+            return func()
+        sql = self.compile(key, objects)
+        if sql is None:
+            return func()
+        return query_cache.get_or_set((key,) + sql, func, self.cache_ttl, self.get_cache_models())
+
     def select_related(self, *args):
         self.objects = self.objects.select_related(*args)
         return self
 
     def filter(self, **kwargs):
-        self.objects = self.objects.filter(**kwargs)
+        """
+        long `__in` lists are sent as one array parameter, see query_parser.LargeIn
+        """
+        self.objects = self.objects.filter(**large_in(kwargs))
         return self
 
     def order(self, *args):
@@ -68,38 +146,114 @@ class BaseManager(six.with_metaclass(DeclarativeMetaclass)):
         return query
 
     def query(self, query=None):
+        """
+        query - Q or query_parser.FilterPlan
+        """
+        if hasattr(query, 'to_q'):
+            query = query.to_q()
         if query:
             self.objects = self.objects.filter(query)
         return self
 
     def icontains(self, *fields, **kwargs):
+        return self.search(*fields, **kwargs)
+
+    def search(self, *fields, **kwargs):
         try:
             value, operator = self.validate_query(*fields, **kwargs)
         except Exception:
             return self
-        query = None
-        for field in fields:
-            query = self.add_subquery(query, field, value, '__icontains', operator)
-        return self.query(query)
+        backend = self.get_search_backend()
+        if not backend.is_available(self.objects, fields):
+            backend = IContainsSearchBackend(self._meta)
+        self.objects = backend.search(self.objects, fields, value, operator)
+        return self
+
+    def get_search_backend(self):
+        return get_search_backend(self._meta)
+
+    def build_search_index(self, *fields):
+        """
+        create the prebuilt index for backends that need one (sqlite_fts)
+        """
+        self.get_search_backend().build_index(self.objects.model, fields, using=self.objects.db)
+        return self
+
+    def only(self, fieldset=None):
+        """
+        narrow `fields` and `related_fields` to mapping.SparseFieldset,
+        related groups are kept when their first path item is a requested resource
+        """
+        if fieldset is None:
+            return self
+        required = self._meta.required_fields
+        self.fields = [f for f in self.fields if f in fieldset.fields or f in required] or self.fields[:1]
+        self.related_fields = tuple(rel_field for rel_field in self.related_fields
+                                    if rel_field[0].split('__')[0] in fieldset.resources)
+        return self
+
+    def expand(self, expansion=None):
+        """
+        drop the related groups of the resources the client didn't expand (mapping.Expansion),
+        groups are matched by their first path item
+        """
+        if expansion is None:
+            return self
+        self.related_fields = tuple(rel_field for rel_field in self.related_fields
+                                    if rel_field[0].split('__')[0] not in expansion.collapsed)
+        return self
 
     def limit(self, start, length):
         self.objects = self.objects[start: start + length]
         return self
 
+    def read_objects(self, objects):
+        """
+        `objects` on a read replica (see routing), querysets bound by `using` and select_for_update() are kept
+        """
+        if objects._db is not None or objects.query.select_for_update:
+            return objects
+        return objects.using(routing.db_for_read(objects.db, self._meta.read_replicas, self._meta.replica_strategy))
+
+    @timing.timed('db')
+    def count(self):
+        objects = self.read_objects(self.objects)
+        return self.fetch(('count',), objects, objects.count)
+
+    @timing.timed('db')
     def custom_query(self):
-        cursor = connection.cursor()
-        cursor.execute(self.objects.values(*self.fields).query.__str__())
-        return cursor.fetchall()
+        objects = self.read_objects(self.objects).values(*self.fields)
+        key = ('custom',) + tuple(self.fields)
+
+        def query():
+            sql = self.compile(key, objects)
+            if sql is None:
+                return []
+            cursor = connections[objects.db].cursor()
+            cursor.execute(*sql)
+            return cursor.fetchall()
+        return self.fetch(key, objects, query)
 
     def to_list(self):
-        self.objects = self.objects.values(*self.fields)
+        self.objects = self.read_objects(self.objects).values(*self.fields)
         return self
 
-    def to_data(self, fields=None, group_fields=None):
+    def to_data(self, fields=None, group_fields=None, layout=None):
+        """
+        layout - 'columns' or 'rows' to get columnar.Columnar over the values_list tuples
+        instead of a dict per row, related values are named by their orm path ('group__name')
+        for an export the rows are export.ExportRows, read by a server-side iterator and not cached
+        """
         fields, related_fields, allways_fields = self.construct_fields(fields or self.fields,
                                                                        group_fields or [ii[0]
                                                                                         for ii in self.related_fields])
-        objects = self.objects.values_list(*allways_fields)
+        objects = self.read_objects(self.objects).values_list(*allways_fields)
+        if export.is_exporting():
+            layout = None
+        if layout:
+            with timing.stage('db'):
+                return Columnar(allways_fields, self.fetch(('rows',) + tuple(allways_fields), objects,
+                                                           lambda: list(objects)), layout)
 
         def mapping(item):
             new_item = dict(zip(fields, item[0:len(fields)]))
@@ -124,7 +278,171 @@ class BaseManager(six.with_metaclass(DeclarativeMetaclass)):
                     .update({keys[-1]: dict(zip(fields_rel, item[start_pos:start_pos + len(fields_rel)]))})
                 start_pos += len(fields_rel)
             return new_item
-        return map(mapping, list(objects))
+        if export.is_exporting():
+            return export.ExportRows(objects, mapping)
+        with timing.stage('db'):
+            objects = self.fetch(('rows',) + tuple(allways_fields), objects, lambda: list(objects))
+        return map(mapping, objects)
+
+    def get_write_db(self):
+        if self.objects._db is not None:
+            return self.objects.db
+        return router.db_for_write(self.objects.model)
+
+    def write_chunks(self, items, write, batch_size=None):
+        """
+        write(chunk, using) -> outcome dict per row, one transaction per chunk,
+        a failed chunk is rolled back and its rows get the 'error' status
+        """
+        items = list(items)
+        size = batch_size or self._meta.batch_size
+        using = self.get_write_db()
+        outcomes = []
+        for start in range(0, len(items), size):
+            chunk = items[start:start + size]
+            try:
+                with transaction.atomic(using=using):
+                    result = write(chunk, using)
+            except (DatabaseError, FieldDoesNotExist, TypeError, ValueError) as e:
+                result = [{'status': 'error', 'error': force_text(e)} for item in chunk]
+            for index, outcome in enumerate(result):
+                outcome['index'] = start + index
+            outcomes.extend(result)
+        routing.mark_write(using)
+        query_cache.invalidate(self.objects.model, using)
+        return outcomes
+
+    def get_key(self, item, fields):
+        opts = self.objects.model._meta
+        return tuple((opts.pk if field == 'pk' else opts.get_field(field)).to_python(item.get(field))
+                     for field in fields)
+
+    def get_existing(self, using, keys, fields):
+        """
+        {key: pk} of the rows with `fields` values in `keys`
+        """
+        objects = self.objects.model._default_manager.using(using)
+        if len(fields) == 1:
+            objects = objects.filter(**{"%s__in" % fields[0]: [key[0] for key in keys]})
+        else:
+            objects = objects.filter(reduce(lambda a, b: a | b, [Q(**dict(zip(fields, key))) for key in keys]))
+        return dict((tuple(row[:-1]), row[-1]) for row in objects.values_list(*(list(fields) + ['pk'])))
+
+    def update_objects(self, using, objs, fields=None):
+        """
+        objs - [(instance, item)], rows are grouped by the updated fields so missing
+        keys of an item never overwrite the column
+        """
+        groups = {}
+        keys = ('pk', self.objects.model._meta.pk.name)
+        for obj, item in objs:
+            names = tuple(sorted(f for f in item if f not in keys and (not fields or f in fields)))
+            if names:
+                groups.setdefault(names, []).append(obj)
+        manager = self.objects.model._default_manager.using(using)
+        for names, group in groups.items():
+            manager.bulk_update(group, names, batch_size=self._meta.batch_size)
+
+    @timing.timed('db')
+    def bulk_create(self, items, batch_size=None):
+        """
+        insert validated dicts, [{'index': i, 'status': 'created', 'id': pk}]
+        id is None on backends that don't return the ids of a bulk insert (only postgresql does),
+        use upsert to get them by a unique key
+        """
+        model = self.objects.model
+
+        def write(chunk, using):
+            objs = [model(**item) for item in chunk]
+            model._default_manager.using(using).bulk_create(objs, batch_size=len(chunk))
+            return [{'status': 'created', 'id': obj.pk} for obj in objs]
+        return self.write_chunks(items, write, batch_size)
+
+    @timing.timed('db')
+    def bulk_update(self, items, fields=None, key='pk', batch_size=None):
+        """
+        update `fields` (default all keys of the item) of the rows found by `key`,
+        status 'updated' or 'missing'
+        """
+        model = self.objects.model
+
+        def write(chunk, using):
+            keys = [self.get_key(item, (key,)) for item in chunk]
+            existing = self.get_existing(using, set(keys), (key,))
+            objs = []
+            result = []
+            for item, item_key in zip(chunk, keys):
+                pk = existing.get(item_key)
+                if pk is None:
+                    result.append({'status': 'missing', 'id': None})
+                    continue
+                values = dict((f, v) for f, v in item.items() if f != key and f != 'pk')
+                obj = model(**values)
+                obj.pk = pk
+                objs.append((obj, values))
+                result.append({'status': 'updated', 'id': pk})
+            self.update_objects(using, objs, fields)
+            return result
+        return self.write_chunks(items, write, batch_size)
+
+    @timing.timed('db')
+    def upsert(self, items, conflict_fields, update_fields=None, batch_size=None):
+        """
+        insert or update by the `conflict_fields` values, one select, one insert
+        and one update per chunk, status 'created', 'updated' or 'duplicate'
+        (an earlier item of the payload with the same key, the last one wins)
+        rows inserted by someone else between the select and the insert are updated
+        on a second attempt, the ids of the created rows are read back by the key
+        when the backend doesn't return them
+        """
+        model = self.objects.model
+        conflict_fields = tuple(conflict_fields)
+        excluded = conflict_fields + ('pk', model._meta.pk.name)
+
+        def write_keys(chunk, keys, using):
+            existing = self.get_existing(using, set(keys), conflict_fields)
+            last = dict((item_key, index) for index, item_key in enumerate(keys))
+            creates = []
+            updates = []
+            result = []
+            for index, (item, item_key) in enumerate(zip(chunk, keys)):
+                if last[item_key] != index:
+                    result.append({'status': 'duplicate', 'id': existing.get(item_key)})
+                    continue
+                pk = existing.get(item_key)
+                obj = model(**item)
+                if pk is None:
+                    creates.append(obj)
+                    result.append({'status': 'created', 'obj': obj, 'key': item_key})
+                else:
+                    obj.pk = pk
+                    values = dict((f, v) for f, v in item.items() if f not in excluded)
+                    updates.append((obj, values))
+                    result.append({'status': 'updated', 'id': pk})
+            if creates:
+                model._default_manager.using(using).bulk_create(creates, batch_size=len(creates))
+                if any(obj.pk is None for obj in creates):
+                    created = self.get_existing(using, set(outcome['key'] for outcome in result
+                                                           if 'obj' in outcome), conflict_fields)
+                    for outcome in result:
+                        if 'obj' in outcome:
+                            outcome['obj'].pk = created.get(outcome['key'])
+            self.update_objects(using, updates, update_fields)
+            for outcome in result:
+                if 'obj' in outcome:
+                    outcome['id'] = outcome.pop('obj').pk
+                    del outcome['key']
+            return result
+
+        def write(chunk, using):
+            keys = [self.get_key(item, conflict_fields) for item in chunk]
+            try:
+                with transaction.atomic(using=using):
+                    return write_keys(chunk, keys, using)
+            except IntegrityError:
+                # a concurrent insert of the same keys, they are found by the select now
+                return write_keys(chunk, keys, using)
+        return self.write_chunks(items, write, batch_size)
 
     def construct_fields(self, base_fields, group_fields):
         fields = copy.deepcopy(base_fields)
@@ -138,9 +456,128 @@ class BaseManager(six.with_metaclass(DeclarativeMetaclass)):
         return fields, related_fields, allways_fields
 
 
+ChainState = namedtuple('ChainState', 'objects fields related_fields cache_ttl')
+
+
+class QueryChain(object):
+    """
+    Immutable BaseManager chain. Every step returns a new chain and reads run
+    on a copy of the manager with a clone of the queryset, so a chain can be
+    defined once at module level and shared by the worker threads:
+
+        ACTIVE_ITEMS = ItemManager().chain().filter(is_active=True).cached(60)
+
+        ACTIVE_ITEMS.order('-id').limit(0, 20).to_data()
+
+    The compiled SQL of each read is memoized in the chain, repeated cached
+    reads don't compile the query again.
+    """
+
+    def __init__(self, manager, state=None):
+        self._manager = manager
+        self._state = state or ChainState(manager.objects, manager.fields, manager.related_fields,
+                                          manager.cache_ttl)
+        self._compiled = {}
+
+    def __repr__(self):
+        return "<QueryChain %s>" % self._manager.__class__.__name__
+
+    def get_manager(self):
+        """
+        a new manager in the state of the chain
+        """
+        manager = copy.copy(self._manager)
+        manager.objects = self._state.objects.all()
+        manager.fields = self._state.fields
+        manager.related_fields = self._state.related_fields
+        manager.cache_ttl = self._state.cache_ttl
+        return manager
+
+    def step(self, name, *args, **kwargs):
+        manager = self.get_manager()
+        getattr(manager, name)(*args, **kwargs)
+        return QueryChain(self._manager, ChainState(manager.objects, manager.fields, manager.related_fields,
+                                                    manager.cache_ttl))
+
+    def read(self, name, *args, **kwargs):
+        manager = self.get_manager()
+        manager.compiled = self._compiled
+        return getattr(manager, name)(*args, **kwargs)
+
+    @property
+    def model(self):
+        return self._state.objects.model
+
+    def select_related(self, *args):
+        return self.step('select_related', *args)
+
+    def filter(self, **kwargs):
+        return self.step('filter', **kwargs)
+
+    def order(self, *args):
+        return self.step('order', *args)
+
+    def query(self, query=None):
+        return self.step('query', query)
+
+    def icontains(self, *fields, **kwargs):
+        return self.step('icontains', *fields, **kwargs)
+
+    def search(self, *fields, **kwargs):
+        return self.step('search', *fields, **kwargs)
+
+    def only(self, fieldset=None):
+        return self.step('only', fieldset)
+
+    def expand(self, expansion=None):
+        return self.step('expand', expansion)
+
+    def limit(self, start, length):
+        return self.step('limit', start, length)
+
+    def cached(self, ttl=60):
+        return self.step('cached', ttl)
+
+    def count(self):
+        return self.read('count')
+
+    def custom_query(self):
+        return self.read('custom_query')
+
+    def to_list(self):
+        """
+        values queryset, the chain itself isn't changed
+        """
+        return self.read('to_list').objects
+
+    def to_data(self, fields=None, group_fields=None, layout=None):
+        return self.read('to_data', fields, group_fields, layout)
+
+
 class BaseMongoManager(BaseManager):
     def __init__(self):
         super(BaseMongoManager, self).__init__()
+        # pymongo is imported by the first mongo manager, not with the package
+        from pymongo import MongoClient
         client = MongoClient('localhost', 27017)
         db = getattr(client, self._meta.db_name)
-        self.table = getattr(db, self._meta.table_name)
\ No newline at end of file
+        self.table = getattr(db, self._meta.table_name)
+
+    def get_cache_models(self):
+        return query_cache.watch(list(self._meta.cache_models) +
+                                 ['mongo.%s.%s' % (self._meta.db_name, self._meta.table_name)])
+
+    def find(self, query=None, projection=None, sort=None):
+        """
+        list of documents, cached by the filter when `cached` is on,
+        invalidate with query_cache.invalidate('mongo.<db_name>.<table_name>')
+        """
+        def fetch():
+            cursor = self.table.find(query or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor)
+        if not self.cache_ttl:
+            return fetch()
+        return query_cache.get_or_set(('find', self._meta.db_name, self._meta.table_name, query, projection, sort),
+                                      fetch, self.cache_ttl, self.get_cache_models())
\ No newline at end of file
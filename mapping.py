@@ -1,14 +1,66 @@
 import types
 
+from contextlib import contextmanager
 import copy
 import importlib
+import threading
+from itertools import islice
 
 from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext_lazy as _
+
+from utils.web_platform import timing, warmup
+from utils.web_platform.columnar import Columnar, NAME_SEPARATOR, PATH_SEPARATOR
+from utils.web_platform.errors.exception import ValidationError
+
+
+_batch = threading.local()
+
+# rows of a list serialized at once by BaseMapping.iter_json
+JSON_CHUNK_SIZE = 500
+
+
+class BatchContext(object):
+    """
+    memoized results of resource loaders: {loader: {key: value}}
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def load(self, loader, keys):
+        cache = self.results.setdefault(loader, {})
+        missing = [key for key in keys if key not in cache]
+        if missing:
+            loaded = loader(missing) or {}
+            for key in missing:
+                cache[key] = loaded.get(key)
+        return cache
+
+
+@contextmanager
+def batch_context(context=None):
+    """
+    share loaded resources between all encodes inside the block (e.g. one request)
+    an already active context wins over `context`
+    """
+    current = getattr(_batch, 'context', None)
+    if current is not None:
+        yield current
+        return
+    _batch.context = context or BatchContext()
+    try:
+        yield _batch.context
+    finally:
+        _batch.context = None
 
 
 class MappingOptions(object):
     fields = {}
     resource_fields = {}
+    # exposed resource names rendered only when the client asks by ?expand=, None - all resources
+    expandable = None
 
     def __new__(cls, meta=None):
         overrides = {}
@@ -25,21 +77,33 @@ class MappingOptions(object):
 class DeclarativeMetaclass(type):
     def __new__(cls, name, bases, attrs):
         resources = {}
+        loaders = {}
         for field_name, obj in attrs.copy().items():
             if hasattr(obj, 'mapping_type'):
                 field = attrs.pop(field_name)
-                resources[field_name] = field.to_class()
+                # MappingResourceField until the first instance resolves it, see BaseMapping.resolve
+                resources[field_name] = field
+                if field.loader is not None:
+                    field.key = field.key or "%s_id" % field_name
+                    loaders[field_name] = field
 
         attrs['resources'] = resources
         new_class = super(DeclarativeMetaclass, cls).__new__(cls, name, bases, attrs)
         opts = getattr(new_class, 'Meta', None)
         new_class._meta = MappingOptions(opts)
         new_class._meta.resources = resources
+        new_class._meta.loaders = loaders
+        new_class._meta.resolved = not resources
+        new_class._meta.batch = bool(loaders)
+        new_class._meta.meta_fields = None
+        warmup.register('mappings', new_class.warm_up)
         return new_class
 
 
 class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
     def __init__(self, mapping_path=None):
+        if not self._meta.resolved:
+            self.resolve()
         self.mapping_path = mapping_path
         self.fields = {}
         self.resource_fields = {}
@@ -48,20 +112,108 @@ class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
         self._create_fields()
         self._create_resource_fields()
 
+    @classmethod
+    def resolve(cls):
+        """
+        import string referenced resources and create their mappings on first use,
+        so defining a mapping doesn't import the modules it refers to
+        """
+        resources = dict((name, field.to_class() if hasattr(field, 'mapping_type') else field)
+                         for name, field in cls._meta.resources.items())
+        cls.resources = cls._meta.resources = resources
+        # resource loaders at this or any nested level
+        cls._meta.batch = bool(cls._meta.loaders) or any(r._meta.batch for r in resources.values())
+        cls._meta.resolved = True
+
+    @classmethod
+    def warm_up(cls):
+        """
+        resolve the resources, import the loaders and build the fields of Meta before the first request
+        """
+        if not cls._meta.resolved:
+            cls.resolve()
+        for field in cls._meta.loaders.values():
+            field.get_loader()
+        cls.get_meta_fields()
+
+    @classmethod
+    def get_meta_fields(cls):
+        """
+        (fields, encode_fields, resource_fields, encode_resource_fields) of Meta, built once per class
+        """
+        if cls._meta.meta_fields is None:
+            fields = copy.deepcopy(cls._meta.fields)
+            resource_fields = copy.deepcopy(cls._meta.resource_fields)
+            cls._meta.meta_fields = (fields, {v: k for k, v in fields.items()},
+                                     resource_fields, {v: k for k, v in resource_fields.items()})
+        return cls._meta.meta_fields
+
     def _create_fields(self):
-        fields = copy.deepcopy(self._meta.fields)
-        fields.update(self.update_fields())
-        self.fields = fields
-        self.encode_fields = {v: k for k, v in fields.items()}
+        fields, encode_fields = self.get_meta_fields()[:2]
+        self.fields = dict(fields)
+        update = self.update_fields()
+        if update:
+            self.fields.update(update)
+            self.encode_fields = {v: k for k, v in self.fields.items()}
+        else:
+            self.encode_fields = dict(encode_fields)
 
     def _create_resource_fields(self):
-        resource_fields = copy.deepcopy(self._meta.resource_fields)
-        resource_fields.update(self.update_resource_fields())
-        self.resource_fields = resource_fields
-        self.encode_resource_fields = {v: k for k, v in resource_fields.items()}
+        resource_fields, encode_resource_fields = self.get_meta_fields()[2:]
+        self.resource_fields = dict(resource_fields)
+        update = self.update_resource_fields()
+        if update:
+            self.resource_fields.update(update)
+            self.encode_resource_fields = {v: k for k, v in self.resource_fields.items()}
+        else:
+            self.encode_resource_fields = dict(encode_resource_fields)
 
     def get_all_fields(self):
-        return self.encode_fields.keys() + self.encode_resource_fields.keys()
+        return list(self.encode_fields.keys()) + list(self.encode_resource_fields.keys())
+
+    def get_exposed_fields(self):
+        return list(self.fields.keys()) + list(self.resource_fields.keys())
+
+    def select(self, names):
+        """
+        encode only the exposed `names`, unknown names raise ValidationError
+        """
+        unknown = [name for name in names if name not in self.fields and name not in self.resource_fields]
+        if unknown:
+            raise ValidationError(detail=_(u"Не валидные входные данные"),
+                                  fields={'fields': {'message': force_text(_(u"Unknown fields")), 'fields': unknown}})
+        self.encode_fields = dict((k, v) for k, v in self.encode_fields.items() if v in names)
+        self.encode_resource_fields = dict((k, v) for k, v in self.encode_resource_fields.items() if v in names)
+        return self
+
+    def sparse_fieldset(self, names):
+        self.select(names)
+        return SparseFieldset(self.__class__, names, self.encode_fields.keys(), self.encode_resource_fields.keys())
+
+    def get_expandable(self):
+        expandable = self._meta.expandable
+        return [name for name in self.resource_fields if expandable is None or name in expandable]
+
+    def expansion(self, names):
+        """
+        Expansion of the exposed resource `names`, names that aren't expandable raise ValidationError
+        """
+        expandable = self.get_expandable()
+        unknown = [name for name in names if name not in expandable]
+        if unknown:
+            raise ValidationError(detail=_(u"Не валидные входные данные"),
+                                  fields={'expand': {'message': force_text(_(u"Unknown resources")),
+                                                     'fields': unknown}})
+        return Expansion(self.__class__, names, [self.resource_fields[name] for name in expandable
+                                                 if name not in names])
+
+    def expand(self, expansion):
+        """
+        encode only the expandable resources of `expansion`
+        """
+        self.encode_resource_fields = dict((k, v) for k, v in self.encode_resource_fields.items()
+                                           if k not in expansion.collapsed)
+        return self
 
     def update_fields(self):
         return {}
@@ -69,7 +221,12 @@ class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
     def update_resource_fields(self):
         return {}
 
+    @timing.timed('mapping')
     def encode(self, data, auto_encode=False):
+        with batch_context():
+            return self.encode_data(self.get_path_data(data), auto_encode)
+
+    def get_path_data(self, data):
         if self.mapping_path:
             data_path = None
             for p in self.mapping_path.split('.'):
@@ -77,20 +234,131 @@ class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
                     data_path = data_path.get(p) if data_path else data.get(p)
                 except AttributeError:
                     pass
-            return self.encode_data(data_path, auto_encode)
-        return self.encode_data(data, auto_encode)
+            return data_path
+        return data
+
+    @timing.timed('mapping')
+    def encode_json(self, data, encode, auto_encode=False):
+        """
+        same string as json.dumps(self.encode(data), sort_keys=True, ensure_ascii=False)
+        written while walking the rows, without the mapped dicts
+        encode - encoder for values that aren't str/int/bool/None, e.g. JsonEncoder(sort_keys=True).encode
+        """
+        return ''.join(self.iter_json(data, encode, auto_encode))
+
+    def iter_json(self, data, encode, auto_encode=False):
+        """
+        encode_json by chunks of JSON_CHUNK_SIZE rows of a top level list,
+        the rows are mapped by convert and written by `encode` (the C encoder of json)
+        """
+        context = BatchContext()
+        with batch_context(context):
+            data = self.get_path_data(data)
+            if not isinstance(data, (list, types.GeneratorType)):
+                yield encode(self.encode_data(data, auto_encode))
+                return
+            prefetched = None
+            if self._meta.batch:
+                data = list(data)
+                prefetched = self.prefetch(data)
+        separator = '['
+        data = iter(data)
+        chunk = list(islice(data, JSON_CHUNK_SIZE))
+        while chunk:
+            with batch_context(context):
+                rows = [self.convert(item, auto_encode, prefetched) for item in chunk]
+            yield separator + encode(rows)[1:-1]
+            separator = ', '
+            chunk = list(islice(data, JSON_CHUNK_SIZE))
+        yield '[]' if separator == '[' else ']'
 
     def encode_data(self, data, auto_encode=False):
         if data is None:
             return None
+        if isinstance(data, Columnar):
+            return self.encode_columnar(data)
         if isinstance(data, (list, types.GeneratorType)):
+            prefetched = None
+            if self._meta.batch:
+                data = list(data)
+                prefetched = self.prefetch(data)
             mapped_items = []
             for item in data:
-                mapped_items.append(self.convert(item, auto_encode))
+                mapped_items.append(self.convert(item, auto_encode, prefetched))
             return mapped_items
-        return self.convert(data, auto_encode)
-
-    def convert(self, item, auto_encode=False):
+        return self.convert(data, auto_encode, self.prefetch([data]) if self._meta.batch else None)
+
+    def encode_columnar(self, data):
+        """
+        columnar envelope with the exposed names ('group.name'),
+        values that aren't exposed by the mapping are dropped
+        """
+        indexes = []
+        names = []
+        for index, path in enumerate(data.fields):
+            name = self.columnar_name(path.split(PATH_SEPARATOR))
+            if name is not None:
+                indexes.append(index)
+                names.append(name)
+        return data.select(indexes, names).envelope()
+
+    def columnar_name(self, bits):
+        if len(bits) == 1:
+            return self.encode_fields.get(bits[0])
+        if bits[0] not in self.encode_resource_fields:
+            return None
+        name = self.resources[bits[0]].columnar_name(bits[1:])
+        if name is None:
+            return None
+        return self.encode_resource_fields[bits[0]] + NAME_SEPARATOR + name
+
+    def prefetch(self, items):
+        """
+        call each resource loader once for all items without the resource
+        return {resource: {key: value}}
+        """
+        context = getattr(_batch, 'context', None) or BatchContext()
+        prefetched = {}
+        for name, field in self._meta.loaders.items():
+            if name not in self.encode_resource_fields:
+                continue
+            keys = []
+            seen = set()
+            for item in items:
+                if not isinstance(item, dict) or item.get(name) is not None:
+                    continue
+                key = item.get(field.key)
+                if key is not None and key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+            prefetched[name] = context.load(field.get_loader(), keys) if keys else {}
+        self.prefetch_nested(items, prefetched)
+        return prefetched
+
+    def prefetch_nested(self, items, prefetched):
+        """
+        load the next level for all items at once, nested encodes then hit the batch context
+        """
+        if getattr(_batch, 'context', None) is None:
+            return
+        for name, resource in self.resources.items():
+            if not resource._meta.batch or name not in self.encode_resource_fields:
+                continue
+            children = []
+            for item in items:
+                if not isinstance(item, dict):
+                    continue
+                val = item.get(name)
+                if val is None and name in prefetched:
+                    val = prefetched[name].get(item.get(self._meta.loaders[name].key))
+                if isinstance(val, list):
+                    children.extend(val)
+                elif isinstance(val, dict):
+                    children.append(val)
+            if children:
+                resource.prefetch(children)
+
+    def convert(self, item, auto_encode=False, prefetched=None):
         new_item = {}
 
         for key, new_key in self.encode_fields.items():
@@ -102,12 +370,17 @@ class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
             else:
                 new_item[new_key] = val
 
+        # resources, loaders and prefetched results are keyed by the item key (the attribute name)
         for key, new_key in self.encode_resource_fields.items():
             val = item.get(key, None)
-            if isinstance(val, list):
+            if val is None and prefetched and key in prefetched:
+                val = prefetched[key].get(item.get(self._meta.loaders[key].key))
+            if isinstance(val, list) and self.resources[key]._meta.batch:
+                new_item[new_key] = self.resources[key].encode_data(val, auto_encode)
+            elif isinstance(val, list):
                 res_items = []
                 for res_item in val:
-                    res_items.append(self.resources[new_key].encode_data(res_item, auto_encode))
+                    res_items.append(self.resources[key].encode_data(res_item, auto_encode))
                 new_item[new_key] = res_items
             elif isinstance(val, dict) and not val:
                 new_item[new_key] = None
@@ -188,21 +461,72 @@ class BaseMapping(six.with_metaclass(DeclarativeMetaclass)):
     """
 
 
+class SparseFieldset(object):
+    """
+    fields requested by the client
+    names - exposed names, fields and resources - internal names of the mapping
+    """
+
+    def __init__(self, mapping_cls, names, fields, resources):
+        self.mapping_cls = mapping_cls
+        self.names = list(names)
+        self.fields = frozenset(fields)
+        self.resources = frozenset(resources)
+
+    def __contains__(self, item):
+        return item in self.fields or item in self.resources
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+class Expansion(object):
+    """
+    resources requested by the client
+    names - exposed names, collapsed - internal names of the expandable resources that weren't requested
+    """
+
+    def __init__(self, mapping_cls, names, collapsed):
+        self.mapping_cls = mapping_cls
+        self.names = list(names)
+        self.collapsed = frozenset(collapsed)
+
+    def __contains__(self, item):
+        return item in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+
 class MappingResourceField(object):
+    """
+    loader - callable (or dotted path) `loader(keys) -> {key: data}` called once per
+    response with the `key` values of all items that don't have the resource,
+    key - item field with the resource key, default '<field name>_id'
+    """
     mapping_type = True
 
-    def __init__(self, path):
+    def __init__(self, path, loader=None, key=None):
+        self.loader = loader
+        self.key = key
         self.map_cls = path
+
+    @property
+    def to_class(self):
         if isinstance(self.map_cls, six.string_types):
             module_bits = self.map_cls.split('.')
             module_path, class_name = '.'.join(module_bits[:-1]), module_bits[-1]
             module = importlib.import_module(module_path)
             self.map_cls = getattr(module, class_name)
-
-    @property
-    def to_class(self):
         return self.map_cls
 
+    def get_loader(self):
+        if isinstance(self.loader, six.string_types):
+            module_bits = self.loader.split('.')
+            module = importlib.import_module('.'.join(module_bits[:-1]))
+            self.loader = getattr(module, module_bits[-1])
+        return self.loader
+
 
 class PagingMapping(BaseMapping):
     #avatar = MappingResourceField(ImageFieldMapping)
@@ -1,12 +1,15 @@
 from functools import wraps
 
 from utils.web_platform.errors import exception
+from utils.web_platform import timing
 
 
 def authenticated(view_func):
     @wraps(view_func)
     def _wrapped_view_func(cls_obj, *args, **kwargs):
-        if cls_obj.user.is_authenticated():
+        with timing.stage('permissions'):
+            is_authenticated = cls_obj.user.is_authenticated()
+        if is_authenticated:
             return view_func(cls_obj, *args, **kwargs)
         raise exception.AuthenticationFailed
     return _wrapped_view_func
@@ -16,11 +19,11 @@ def allow_method_by_perms(*perms):
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, *args, **kwargs):
-            if not cls_obj.user.is_authenticated():
-                raise exception.NotAuthenticated
-            if cls_obj.user.is_superuser:
-                return view_func(cls_obj, *args, **kwargs)
-            if cls_obj.user.has_company_perms(cls_obj.company, *perms):
+            with timing.stage('permissions'):
+                if not cls_obj.user.is_authenticated():
+                    raise exception.NotAuthenticated
+                allowed = cls_obj.user.is_superuser or cls_obj.user.has_company_perms(cls_obj.company, *perms)
+            if allowed:
                 return view_func(cls_obj, *args, **kwargs)
             raise exception.PermissionDenied
         return _wrapped_view_func
@@ -31,12 +34,13 @@ def allow_method_by_group(*groups):
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, *args, **kwargs):
-            if not cls_obj.user.is_authenticated():
-                raise exception.NotAuthenticated
-            for gr in groups:
-                if cls_obj.user.has_group(gr):
-                    response = view_func(cls_obj, *args, **kwargs)
-                    return response
+            with timing.stage('permissions'):
+                if not cls_obj.user.is_authenticated():
+                    raise exception.NotAuthenticated
+                allowed = any(cls_obj.user.has_group(gr) for gr in groups)
+            if allowed:
+                response = view_func(cls_obj, *args, **kwargs)
+                return response
             raise exception.PermissionDenied
         return _wrapped_view_func
     return decorator
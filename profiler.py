@@ -0,0 +1,253 @@
+"""
+Per-request database query profiler.
+
+    WEB_API_QUERY_PROFILER = True         # default settings.DEBUG, Meta.query_profiler per resource
+    WEB_API_QUERY_MAX_COUNT = 50          # queries per request
+    WEB_API_QUERY_MAX_SIMILAR = 5         # runs of the same statement with other params (N+1)
+    WEB_API_QUERY_MAX_DUPLICATES = 1      # runs of the same statement with the same params
+    WEB_API_QUERY_MAX_TIME = 500          # milliseconds spent in the database
+    WEB_API_QUERY_PROFILER_MODE = 'log'   # or 'raise' to fail tests with QueryBudgetExceeded
+
+SQL is recorded through the connection execute wrappers, Mongo commands
+of BaseMongoManager through a pymongo command listener. Each query keeps
+the frame of the code outside django and this package that ran it.
+"""
+from collections import namedtuple, OrderedDict
+import logging
+import os
+import sysconfig
+import threading
+import traceback
+
+import django
+from django.conf import settings
+from django.db import connections
+
+from utils.web_platform import timing
+
+logger = logging.getLogger('error_server')
+
+LOG = 'log'
+RAISE = 'raise'
+
+_local = threading.local()
+_skip_paths = (os.path.dirname(os.path.abspath(__file__)), os.path.dirname(django.__file__),
+               sysconfig.get_paths()['stdlib'], sysconfig.get_paths()['purelib'])
+_mongo_listener = None
+
+QueryRecord = namedtuple('QueryRecord', 'vendor sql params duration frame')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def get_frame():
+    """
+    'file:line in function' of the innermost frame of the project code
+    """
+    for filename, lineno, name, _ in reversed(traceback.extract_stack()):
+        if not os.path.abspath(filename).startswith(_skip_paths):
+            return "%s:%s in %s" % (filename, lineno, name)
+    return None
+
+
+class QueryProfile(object):
+    def __init__(self):
+        self.queries = []
+
+    def add(self, vendor, sql, params, duration):
+        self.queries.append(QueryRecord(vendor, sql, params, duration, get_frame()))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(query.duration for query in self.queries) * 1000
+
+    def group(self, key):
+        groups = OrderedDict()
+        for query in self.queries:
+            groups.setdefault(key(query), []).append(query)
+        return groups
+
+    def similar(self, threshold=2):
+        """
+        [(sql, queries)] of statements run at least `threshold` times, N+1 candidates
+        """
+        return [(sql, queries) for sql, queries in self.group(lambda q: (q.vendor, q.sql)).items()
+                if len(queries) >= threshold]
+
+    def duplicates(self, threshold=2):
+        return [(sql, queries) for sql, queries in self.group(lambda q: (q.vendor, q.sql, repr(q.params))).items()
+                if len(queries) >= threshold]
+
+    def problems(self, max_count=None, max_similar=None, max_duplicates=None, max_time=None):
+        problems = []
+        if max_count is not None and self.count > max_count:
+            problems.append("%s queries, limit %s" % (self.count, max_count))
+        if max_time is not None and self.time > max_time:
+            problems.append("%.2f ms in the database, limit %s ms" % (self.time, max_time))
+        if max_similar is not None:
+            for key, queries in self.similar(max_similar + 1):
+                frames = sorted(set(q.frame for q in queries if q.frame))
+                problems.append("N+1: %s runs of %s from %s" % (len(queries), key[1], ", ".join(frames)))
+        if max_duplicates is not None:
+            for key, queries in self.duplicates(max_duplicates + 1):
+                problems.append("%s identical runs of %s with %r" % (len(queries), key[1], queries[0].params))
+        return problems
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'time': round(self.time, 2),
+            'similar': [{'sql': key[1], 'count': len(queries), 'frames': sorted(set(q.frame for q in queries
+                                                                                    if q.frame))}
+                        for key, queries in self.similar()],
+            'queries': [{'sql': q.sql, 'params': repr(q.params), 'time': round(q.duration * 1000, 2),
+                         'frame': q.frame} for q in self.queries],
+        }
+
+
+class ExecuteWrapper(object):
+    """
+    connection.execute_wrappers item recording into `profile`
+    """
+
+    def __init__(self, profile, vendor):
+        self.profile = profile
+        self.vendor = vendor
+
+    def __call__(self, execute, sql, params, many, context):
+        started = timing.clock()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.profile.add(self.vendor, sql, params, timing.clock() - started)
+
+
+def install_mongo_listener():
+    global _mongo_listener
+    if _mongo_listener is not None:
+        return
+    try:
+        from pymongo import monitoring
+    except ImportError:
+        _mongo_listener = False
+        return
+
+    class MongoListener(monitoring.CommandListener):
+        def __init__(self):
+            self.commands = {}
+
+        def started(self, event):
+            profile = getattr(_local, 'profile', None)
+            if profile is not None:
+                self.commands[event.request_id] = (event.command_name, dict(event.command))
+
+        def succeeded(self, event):
+            self.finish(event)
+
+        def failed(self, event):
+            self.finish(event)
+
+        def finish(self, event):
+            command = self.commands.pop(event.request_id, None)
+            profile = getattr(_local, 'profile', None)
+            if command is not None and profile is not None:
+                name, body = command
+                body.pop('lsid', None)
+                profile.add('mongo', name, body, event.duration_micros / 1000000.0)
+
+    _mongo_listener = MongoListener()
+    monitoring.register(_mongo_listener)
+
+
+def is_enabled(enabled=None):
+    if enabled is None:
+        return getattr(settings, 'WEB_API_QUERY_PROFILER', settings.DEBUG)
+    return enabled
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def start(enabled=None):
+    stop()
+    if not is_enabled(enabled):
+        return None
+    return attach(QueryProfile())
+
+
+def attach(profile):
+    """
+    record the queries of this thread into `profile`, also of another thread
+    """
+    _local.profile = profile
+    _local.wrappers = []
+    for connection in connections.all():
+        wrapper = ExecuteWrapper(profile, connection.vendor)
+        connection.execute_wrappers.append(wrapper)
+        _local.wrappers.append((connection, wrapper))
+    install_mongo_listener()
+    return profile
+
+
+def stop():
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    for connection, wrapper in getattr(_local, 'wrappers', ()):
+        if wrapper in connection.execute_wrappers:
+            connection.execute_wrappers.remove(wrapper)
+    _local.wrappers = []
+    return profile
+
+
+def check(profile, label=None):
+    problems = profile.problems(max_count=getattr(settings, 'WEB_API_QUERY_MAX_COUNT', 50),
+                                max_similar=getattr(settings, 'WEB_API_QUERY_MAX_SIMILAR', 5),
+                                max_duplicates=getattr(settings, 'WEB_API_QUERY_MAX_DUPLICATES', 1),
+                                max_time=getattr(settings, 'WEB_API_QUERY_MAX_TIME', 500))
+    if not problems:
+        return problems
+    message = "Query budget exceeded%s:\n%s" % (" by %s" % label if label else "", "\n".join(problems))
+    if getattr(settings, 'WEB_API_QUERY_PROFILER_MODE', LOG) == RAISE:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+    return problems
+
+
+def finish(request, response):
+    """
+    stop recording, check the thresholds and add the X-Query-* headers in debug mode
+    """
+    profile = stop()
+    if profile is None:
+        return response
+    if settings.DEBUG:
+        response['X-Query-Count'] = str(profile.count)
+        response['X-Query-Time'] = "%.2f" % profile.time
+    check(profile, "%s %s" % (request.method, request.path))
+    return response
+
+
+class profile(object):
+    """
+    with profile() as queries:
+        ...
+    queries.problems(max_similar=1)
+    """
+
+    def __init__(self):
+        self.queries = None
+
+    def __enter__(self):
+        self.queries = start(True)
+        return self.queries
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        stop()
+        return False
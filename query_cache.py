@@ -0,0 +1,171 @@
+"""
+Result cache for BaseManager.cached().
+
+    WEB_API_QUERY_CACHE_SIZE = 1000       # entries of the in-process LRU
+    WEB_API_QUERY_CACHE = 'default'       # optional django cache shared by the workers
+
+Entries are keyed by the compiled SQL and params together with the
+generation of every model the manager depends on. Saving or deleting one
+of these models bumps its generation (in the shared cache too when it is
+configured), so older entries are never read again and age out of the LRU.
+With a shared cache every saved or deleted model is bumped, the workers
+writing a model don't have to read it through the cache to invalidate it.
+Inside a transaction the generation is bumped again on commit, results
+cached by other workers before the commit are dropped as well.
+The in-process LRU keeps results pickled, every read gets its own copy.
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils.encoding import force_bytes
+import six
+from six.moves import cPickle as pickle
+
+QUERY_CACHE_SIZE = 1000
+MISSING = object()
+
+_watched = set()
+_generations = {}
+
+
+class QueryCache(object):
+    """
+    bounded LRU with a ttl per entry, values are stored pickled
+    """
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.pop(key, None)
+            if entry is None:
+                return MISSING
+            if entry[0] < time.time():
+                return MISSING
+            self.items[key] = entry
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, ttl):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + ttl, data)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+_local_cache = None
+
+
+def get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = QueryCache(getattr(settings, 'WEB_API_QUERY_CACHE_SIZE', QUERY_CACHE_SIZE))
+    return _local_cache
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'WEB_API_QUERY_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def get_label(model):
+    if isinstance(model, six.string_types):
+        return model.lower()
+    return model._meta.label_lower
+
+
+def watch(models):
+    """
+    labels of the models whose changes invalidate cached results
+    """
+    labels = [get_label(model) for model in models]
+    _watched.update(labels)
+    return labels
+
+
+def generation_key(label):
+    return 'web_api:qc:gen:%s' % label
+
+
+def get_generations(labels):
+    shared = get_shared_cache()
+    if shared is None:
+        return [_generations.get(label, 0) for label in labels]
+    values = shared.get_many([generation_key(label) for label in labels])
+    return [values.get(generation_key(label), 0) for label in labels]
+
+
+def invalidate(model, using=None):
+    """
+    drop the cached results of `model`, again when the transaction of `using` commits
+    """
+    label = get_label(model)
+    bump(label)
+    if transaction.get_connection(using or DEFAULT_DB_ALIAS).in_atomic_block:
+        transaction.on_commit(lambda: bump(label), using=using)
+
+
+def bump(label):
+    _generations[label] = _generations.get(label, 0) + 1
+    shared = get_shared_cache()
+    if shared is not None:
+        key = generation_key(label)
+        try:
+            shared.incr(key)
+        except ValueError:
+            # no such key yet, a lost race only invalidates once more
+            shared.set(key, 1, None)
+
+
+def make_key(parts, labels):
+    labels = sorted(labels)
+    source = repr((parts, labels, get_generations(labels)))
+    return 'web_api:qc:%s' % hashlib.md5(force_bytes(source)).hexdigest()
+
+
+def get_or_set(parts, func, ttl, labels):
+    """
+    cached func() for the key `parts`, `labels` - models the result depends on
+    """
+    key = make_key(parts, labels)
+    local = get_local_cache()
+    value = local.get(key)
+    if value is not MISSING:
+        return value
+    shared = get_shared_cache()
+    if shared is not None:
+        value = shared.get(key, MISSING)
+        if value is not MISSING:
+            return local.set(key, value, ttl)
+    value = func()
+    if shared is not None:
+        shared.set(key, value, ttl)
+    return local.set(key, value, ttl)
+
+
+def _on_change(sender, **kwargs):
+    models = [sender, kwargs.get('model'), type(kwargs['instance']) if kwargs.get('instance') is not None else None]
+    shared = get_shared_cache() is not None
+    for label in set(get_label(model) for model in models if model is not None):
+        if shared or label in _watched:
+            invalidate(label, kwargs.get('using'))
+
+
+post_save.connect(_on_change, dispatch_uid='web_platform_query_cache_post_save')
+post_delete.connect(_on_change, dispatch_uid='web_platform_query_cache_post_delete')
+m2m_changed.connect(_on_change, dispatch_uid='web_platform_query_cache_m2m_changed')
@@ -1,5 +1,353 @@
 # coding=utf-8
+"""
+Filter syntax (`f` parameter):
+
+    f=key:v1|v2,key2:>=10,!key3:null
+
+    key:v1|v2       equal to one of the values
+    key:>5          gt, also >=, <, <=
+    key:5..10       range, open ends are allowed: 5.. or ..10
+    key:abc*        starts with
+    key:null        is null
+    !key:...        negation of the whole item
+
+Values are OR-ed, items are AND-ed. A backslash escapes the next
+character, a value with escaped characters is always compared as is.
+
+Lists longer than settings.WEB_API_FILTER_LARGE_IN (default 500) use the
+`large_in` lookup: one array parameter instead of one per value.
+"""
+from collections import namedtuple, OrderedDict
 from functools import wraps
+import json
+import threading
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Field, ForeignObject, Q
+from django.db.models.fields.related_lookups import MultiColSource, RelatedIn
+from django.db.models.lookups import In
+import six
+
+from utils.web_platform.errors import exception
+
+ITEM_SEPARATOR = ','
+KEY_SEPARATOR = ':'
+VALUE_SEPARATOR = '|'
+ESCAPE = '\\'
+NEGATION = '!'
+NULL = 'null'
+RANGE = '..'
+PREFIX = '*'
+OPERATORS = (('>=', 'gte'), ('<=', 'lte'), ('>', 'gt'), ('<', 'lt'))
+
+FILTER_CACHE_SIZE = 1024
+FILTER_CACHE_CHARS = 1000000
+LARGE_IN_SIZE = 500
+
+FilterTerm = namedtuple('FilterTerm', 'op value')
+FilterClause = namedtuple('FilterClause', 'key terms negate')
+
+
+class PlanCache(object):
+    """
+    bounded LRU cache for parsed plans keyed by the raw string or a key built on it,
+    `max_chars` bounds the total length of the raw strings (long id lists)
+    """
+
+    def __init__(self, size=FILTER_CACHE_SIZE, max_chars=FILTER_CACHE_CHARS):
+        self.size = size
+        self.max_chars = max_chars
+        self.chars = 0
+        # {key: (value, length)}
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            self.items[key] = item
+            return item[0]
+
+    def set(self, key, value, raw=None):
+        """
+        raw - the string the key is built on, the key itself by default
+        """
+        if raw is None:
+            raw = key
+        length = len(raw) if raw else 0
+        if length > self.max_chars:
+            return value
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.chars -= old[1]
+            self.items[key] = (value, length)
+            self.chars += length
+            while len(self.items) > self.size or self.chars > self.max_chars:
+                _, (_, old_length) = self.items.popitem(last=False)
+                self.chars -= old_length
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.chars = 0
+
+
+class FilterPlan(dict):
+    """
+    Parsed filter.
+    As a dict it keeps the old `{key: [values]}` view with the items that
+    are a plain list of values, `clauses` holds every parsed item.
+    validation.validate_filter rejects the other items unless the view reads the plan by to_q.
+    """
+
+    def __init__(self, clauses=(), raw=None, data=None, key=None, names=None):
+        super(FilterPlan, self).__init__()
+        self.clauses = tuple(clauses)
+        self.raw = raw
+        # cache key of the plan: the raw string and the mappings applied to it
+        self.key = raw if key is None else key
+        # {key: key of the client} for the keys renamed by remap
+        self.names = names or {}
+        if data is None:
+            for clause in self.clauses:
+                if self.is_plain(clause):
+                    self[clause.key] = [term.value for term in clause.terms]
+        else:
+            self.update(data)
+
+    def copy(self):
+        """
+        the clauses are immutable, the value lists of the dict view are copied
+        """
+        data = dict((key, list(value) if isinstance(value, list) else value) for key, value in self.items())
+        return FilterPlan(self.clauses, self.raw, data, self.key, self.names)
+
+    def client_name(self, key):
+        """
+        name of `key` in the filter of the request, for the errors
+        """
+        return self.names.get(key, key)
+
+    def is_plain(self, clause):
+        """
+        the dict view holds the clause: not negated, only values to be equal to
+        """
+        return not clause.negate and all(term.op == 'eq' for term in clause.terms)
+
+    def remap(self, params_mapping, mapping_key=None):
+        """
+        rename keys by `{new_key: key}` and drop unknown keys
+        mapping_key - hashable identity of params_mapping for the plan key
+        """
+        if mapping_key is None:
+            mapping_key = tuple(sorted(params_mapping.items()))
+        inv_map = dict((v, k) for k, v in params_mapping.items())
+        clauses = [clause._replace(key=inv_map[clause.key]) for clause in self.clauses if clause.key in inv_map]
+        names = dict((new_key, self.client_name(key)) for new_key, key in params_mapping.items())
+        return FilterPlan(clauses, self.raw, decode_keys(params_mapping, self), (self.key, mapping_key), names)
+
+    def to_q(self, **lookups):
+        """
+        compile to Q, `lookups` map keys to orm paths
+        """
+        query = Q()
+        for clause in self.clauses:
+            query &= clause_to_q(clause, lookups.get(clause.key, clause.key))
+        return query
+
+
+class LargeInMixin(object):
+    """
+    `in` for long lists, one parameter for the whole list keeps the statement the same for any length:
+    `= ANY(%s::type[])` on postgresql, `IN (SELECT value FROM json_each(%s))` on sqlite,
+    the plain `IN` on other databases, for subqueries and multi-column relations
+    """
+    lookup_name = 'large_in'
+
+    def get_values(self, connection):
+        """
+        unique db values of a plain list, None when it's a subquery or holds expressions
+        """
+        if isinstance(self.lhs, MultiColSource) or not self.rhs_is_direct_value() or \
+                any(hasattr(value, 'resolve_expression') for value in self.rhs):
+            return None
+        field = self.lhs.output_field
+        values = [field.get_db_prep_value(value, connection, prepared=True) for value in self.rhs if value is not None]
+        try:
+            values = list(OrderedDict.fromkeys(values))
+        except TypeError:
+            pass
+        if not values:
+            raise EmptyResultSet
+        return values
+
+    def as_postgresql(self, compiler, connection):
+        values = self.get_values(connection)
+        if values is None:
+            return self.as_sql(compiler, connection)
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        db_type = self.lhs.output_field.cast_db_type(connection)
+        return '%s = ANY(%%s::%s[])' % (lhs, db_type), list(lhs_params) + [values]
+
+    def as_sqlite(self, compiler, connection):
+        values = self.get_values(connection)
+        if values is None or not all(isinstance(value, six.string_types + six.integer_types + (float,))
+                                     for value in values):
+            return self.as_sql(compiler, connection)
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        return '%s IN (SELECT value FROM json_each(%%s))' % lhs, list(lhs_params) + [json.dumps(values)]
+
+
+@Field.register_lookup
+class LargeIn(LargeInMixin, In):
+    pass
+
+
+@ForeignObject.register_lookup
+class RelatedLargeIn(LargeInMixin, RelatedIn):
+    """
+    large_in of foreign keys, ids or model instances
+    """
+
+
+def get_large_in_size():
+    return getattr(settings, 'WEB_API_FILTER_LARGE_IN', LARGE_IN_SIZE)
+
+
+def in_lookup(lookup, values):
+    """
+    `lookup__in`, `lookup__large_in` for lists longer than settings.WEB_API_FILTER_LARGE_IN
+    """
+    return "%s__%s" % (lookup, LargeIn.lookup_name if len(values) > get_large_in_size() else In.lookup_name)
+
+
+def large_in(kwargs):
+    """
+    filter kwargs with the long `__in` lists moved to `__large_in`
+    """
+    size = get_large_in_size()
+    new_kwargs = {}
+    for key, value in kwargs.items():
+        if key.endswith('__in') and isinstance(value, (list, tuple, set, frozenset)) and len(value) > size:
+            key = in_lookup(key[:-len('__in')], value)
+        new_kwargs[key] = value
+    return new_kwargs
+
+
+def clause_to_q(clause, lookup):
+    query = Q()
+    values = [term.value for term in clause.terms if term.op == 'eq']
+    if len(values) == 1:
+        query |= Q(**{lookup: values[0]})
+    elif values:
+        query |= Q(**{in_lookup(lookup, values): values})
+    for term in clause.terms:
+        if term.op == 'eq':
+            continue
+        elif term.op == 'null':
+            query |= Q(**{"%s__isnull" % lookup: True})
+        elif term.op == 'prefix':
+            query |= Q(**{"%s__startswith" % lookup: term.value})
+        elif term.op == 'range':
+            low, high = term.value
+            if low is not None and high is not None:
+                query |= Q(**{"%s__range" % lookup: (low, high)})
+            elif low is not None:
+                query |= Q(**{"%s__gte" % lookup: low})
+            else:
+                query |= Q(**{"%s__lte" % lookup: high})
+        else:
+            query |= Q(**{"%s__%s" % (lookup, term.op): term.value})
+    return ~query if clause.negate else query
+
+
+def tokenize_filter(path):
+    """
+    single pass over the string
+    yield ((key, is_literal) or None, [(value, is_literal), ...]) for each item
+    """
+    key = None
+    values = []
+    buf = []
+    literal = False
+    escaped = False
+    for char in path:
+        if escaped:
+            buf.append(char)
+            escaped = False
+        elif char == ESCAPE:
+            escaped = literal = True
+        elif char == ITEM_SEPARATOR:
+            if key is not None or buf:
+                values.append((''.join(buf), literal))
+                yield key, values
+            key, values, buf, literal = None, [], [], False
+        elif key is None and char == KEY_SEPARATOR:
+            key, buf, literal = (''.join(buf), literal), [], False
+        elif key is not None and char == VALUE_SEPARATOR:
+            values.append((''.join(buf), literal))
+            buf, literal = [], False
+        else:
+            buf.append(char)
+    if escaped:
+        raise exception.ParseError(u"Unexpected end of filter")
+    if key is not None or buf:
+        values.append((''.join(buf), literal))
+        yield key, values
+
+
+def parse_term(value, literal):
+    if literal:
+        return FilterTerm('eq', value)
+    if value == NULL:
+        return FilterTerm('null', None)
+    for operator, op in OPERATORS:
+        if value.startswith(operator):
+            if len(value) == len(operator):
+                raise exception.ParseError(u"Empty value for '%s'" % operator)
+            return FilterTerm(op, value[len(operator):])
+    if RANGE in value:
+        low, high = value.split(RANGE, 1)
+        if not low and not high:
+            raise exception.ParseError(u"Empty range")
+        return FilterTerm('range', (low or None, high or None))
+    if len(value) > 1 and value.endswith(PREFIX):
+        return FilterTerm('prefix', value[:-1])
+    return FilterTerm('eq', value)
+
+
+def parse_filter_plan(path):
+    clauses = []
+    for key, values in tokenize_filter(path):
+        if key is None:
+            raise exception.ParseError(u"Filter item '%s' has no value" % values[0][0])
+        key, key_literal = key
+        negate = not key_literal and key.startswith(NEGATION)
+        if negate:
+            key = key[1:]
+        if not key:
+            raise exception.ParseError(u"Filter item without key")
+        clauses.append(FilterClause(str(key), tuple(parse_term(v, l) for v, l in values), negate))
+    return FilterPlan(clauses, path)
+
+
+_filter_cache = PlanCache()
+
+
+def parse_filter(path):
+    """
+    parsed plans are cached by the raw string, callers get a copy
+    """
+    path = path or ''
+    plan = _filter_cache.get(path)
+    if plan is None:
+        plan = _filter_cache.set(path, parse_filter_plan(path))
+    return plan.copy()
 
 
 def decode_keys(params_mapping, data):
@@ -10,28 +358,16 @@ def decode_keys(params_mapping, data):
 
 
 def decode_filter_data(path):
-    items = path.split(",") if path else []
-    new_items = dict()
-    for item in items:
-        try:
-            spl_val = item.split(":")
-            if len(spl_val) == 1:
-                raise ValueError
-            elif len(spl_val) > 2:
-                key = spl_val[0]
-                values = ":".join(spl_val[1:])
-            else:
-                key, values = spl_val
-        except ValueError:
-            continue
-        new_items[str(key)] = values.split("|")
-    return new_items
+    return parse_filter(path)
 
 
 def decode_order_data(path, **params_mapping):
+    return decode_order_items(path, {v: k for k, v in params_mapping.items()})
+
+
+def decode_order_items(path, inv_map):
     items = path.split("|")
     new_items = []
-    inv_map = {v: k for k, v in params_mapping.items()}
     for item in items:
         if item:
             prefix = "-" if item[0] == "-" else ""
@@ -43,26 +379,33 @@ def decode_order_data(path, **params_mapping):
 
 
 def filter_mapping(**params_mapping):
+    remapped = PlanCache()
+    mapping_key = tuple(sorted(params_mapping.items()))
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, request, *args, **kwargs):
             data = request.data
             if data and data.get('f'):
-                decode_data = decode_filter_data(data['f'])
-                request.data['f'] = decode_keys(params_mapping, decode_data)
+                plan = remapped.get(data['f'])
+                if plan is None:
+                    plan = remapped.set(data['f'], parse_filter(data['f']).remap(params_mapping, mapping_key))
+                request.data['f'] = plan.copy()
             return view_func(cls_obj, request, *args, **kwargs)
         return _wrapped_view_func
     return decorator
 
 
 def order_mapping(**params_mapping):
+    inv_map = {v: k for k, v in params_mapping.items()}
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, request, *args, **kwargs):
             data = request.data
             if data and data.get('o'):
-                decode_data = decode_order_data(data['o'], **params_mapping)
+                decode_data = decode_order_items(data['o'], inv_map)
                 request.data['o'] = decode_data
             return view_func(cls_obj, request, *args, **kwargs)
         return _wrapped_view_func
-    return decorator
\ No newline at end of file
+    return decorator
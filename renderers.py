@@ -0,0 +1,288 @@
+"""
+Renderers and parsers for BaseWebApi content negotiation.
+
+The response format is picked from the Accept header among the resource renderers:
+
+    class Meta:
+        renderers = ('application/json', 'application/msgpack')   # default - all available
+        parsers = ('application/json', 'application/msgpack')     # default - all available
+
+MessagePack (msgpack) and CBOR (cbor2) are optional, their renderers and parsers
+are available when the package is installed.
+"""
+import datetime
+import types
+
+from django.core.serializers import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.encoding import force_text
+from django.utils.functional import Promise
+
+from utils.web_platform.columnar import Columnar, MEDIA_TYPE as COLUMNAR_MEDIA_TYPE
+from utils.web_platform.errors import exception
+from utils.web_platform import warmup
+
+_modules = {}
+
+
+def optional_import(name):
+    """
+    module or None when it isn't installed, imported on first use
+    """
+    if name not in _modules:
+        try:
+            _modules[name] = __import__(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
+
+
+def to_primitive(o):
+    """
+    types the binary formats don't know, as the json encoder writes them
+    """
+    if isinstance(o, Promise):
+        return force_text(o)
+    elif isinstance(o, (set, types.GeneratorType)):
+        return list(o)
+    elif isinstance(o, Columnar):
+        return o.envelope()
+    return DjangoJSONEncoder().default(o)
+
+
+class BaseRenderer(object):
+    media_type = None
+    # other names of the same type, e.g. application/x-msgpack
+    aliases = ()
+    format = None
+    module = None
+
+    def is_available(self):
+        return self.module is None or optional_import(self.module) is not None
+
+    def matches(self, media_range):
+        if media_range == '*/*':
+            return True
+        if media_range.endswith('/*'):
+            return self.media_type.split('/')[0] == media_range[:-2]
+        return media_range == self.media_type or media_range in self.aliases
+
+    def render(self, api, data):
+        raise NotImplementedError
+
+
+class JSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+
+    def render(self, api, data):
+        return api.json_response(data, content_type=self.media_type)
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    json for clients asking for the columnar envelope by the Accept header
+    """
+    media_type = COLUMNAR_MEDIA_TYPE
+
+
+class XMLRenderer(BaseRenderer):
+    media_type = 'text/xml'
+    aliases = ('application/xml',)
+    format = 'xml'
+
+    def render(self, api, data):
+        return api.xml_response(data)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    aliases = ('application/x-msgpack', 'application/vnd.msgpack')
+    format = 'msgpack'
+    module = 'msgpack'
+
+    def render(self, api, data):
+        msgpack = optional_import(self.module)
+        content = msgpack.packb(data, default=to_primitive, use_bin_type=True)
+        return HttpResponse(content, content_type=self.media_type)
+
+
+def encode_cbor_primitive(encoder, value):
+    encoder.encode(to_primitive(value))
+
+
+class CBORRenderer(BaseRenderer):
+    media_type = 'application/cbor'
+    format = 'cbor'
+    module = 'cbor2'
+
+    def render(self, api, data):
+        cbor2 = optional_import(self.module)
+        # datetimes as the same strings the other formats have, cbor2 refuses naive ones
+        content = cbor2.dumps(data, default=encode_cbor_primitive, encoders={datetime.datetime: encode_cbor_primitive})
+        return HttpResponse(content, content_type=self.media_type)
+
+
+class BaseParser(object):
+    media_type = None
+    aliases = ()
+    module = None
+
+    def is_available(self):
+        return self.module is None or optional_import(self.module) is not None
+
+    def matches(self, content_type):
+        return content_type == self.media_type or content_type in self.aliases
+
+    def parse(self, request):
+        raise NotImplementedError
+
+
+class JSONParser(BaseParser):
+    media_type = 'application/json'
+
+    def parse(self, request):
+        try:
+            return json.json.loads(request.body.decode('utf-8')) if request.body else None
+        except ValueError:
+            raise exception.ParseError
+
+
+class PlainTextParser(BaseParser):
+    media_type = 'text/plain'
+
+    def parse(self, request):
+        return request.body if request.body else None
+
+
+class FormParser(BaseParser):
+    media_type = 'application/x-www-form-urlencoded'
+
+    def parse(self, request):
+        return dict(request.POST.copy())
+
+
+class MultiPartParser(BaseParser):
+    media_type = 'multipart/form-data'
+
+    def parse(self, request):
+        data = dict(request.POST.copy())
+        if request.files:
+            data.update(request.files)
+        return data
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+    aliases = ('application/x-msgpack', 'application/vnd.msgpack')
+    module = 'msgpack'
+
+    def parse(self, request):
+        if not request.body:
+            return None
+        try:
+            return optional_import(self.module).unpackb(request.body, raw=False)
+        except Exception:
+            raise exception.ParseError
+
+
+class CBORParser(BaseParser):
+    media_type = 'application/cbor'
+    module = 'cbor2'
+
+    def parse(self, request):
+        if not request.body:
+            return None
+        try:
+            return optional_import(self.module).loads(request.body)
+        except Exception:
+            raise exception.ParseError
+
+
+RENDERERS = [JSONRenderer(), ColumnarJSONRenderer(), MessagePackRenderer(), CBORRenderer()]
+# offered only to the resources naming them in Meta.renderers or Meta.default_format,
+# xml_response sends the data as is and can't serialize the mapped payloads
+EXTRA_RENDERERS = [XMLRenderer()]
+PARSERS = [JSONParser(), PlainTextParser(), FormParser(), MultiPartParser(), MessagePackParser(), CBORParser()]
+
+
+def warm_up():
+    """
+    import the optional modules of the renderers and parsers
+    """
+    return len([item for item in RENDERERS + EXTRA_RENDERERS + PARSERS if item.is_available()])
+
+
+warmup.register('renderers', warm_up)
+
+
+def register_renderer(renderer):
+    RENDERERS.append(renderer)
+    return renderer
+
+
+def register_parser(parser):
+    PARSERS.append(parser)
+    return parser
+
+
+def get_renderers(media_types=None, default=None):
+    """
+    available renderers for `media_types` (all when None), the one for `default` first
+    """
+    extra = [renderer for renderer in EXTRA_RENDERERS
+             if (media_types is not None and renderer.media_type in media_types) or
+             (default and renderer.matches(default))]
+    renderers = [renderer for renderer in RENDERERS + extra if renderer.is_available() and
+                 (media_types is None or renderer.media_type in media_types)]
+    if default:
+        renderers.sort(key=lambda renderer: not renderer.matches(default))
+    return renderers
+
+
+def get_parser(content_type, media_types=None):
+    for parser in PARSERS:
+        if parser.matches(content_type) and (media_types is None or parser.media_type in media_types):
+            return parser if parser.is_available() else None
+    return None
+
+
+def parse_accept(accept):
+    """
+    [(media range, q)] best first, more specific ranges win on equal q
+    """
+    ranges = []
+    for index, item in enumerate(accept.split(',')):
+        bits = [bit.strip() for bit in item.split(';')]
+        if not bits[0]:
+            continue
+        q = 1.0
+        for param in bits[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_range = bits[0].lower()
+        specificity = 0 if media_range == '*/*' else 1 if media_range.endswith('/*') else 2
+        ranges.append((-q, -specificity, index, media_range, q))
+    return [(media_range, q) for _, _, _, media_range, q in sorted(ranges)]
+
+
+def select_renderer(accept, renderers):
+    """
+    first renderer for the best acceptable media range, None when nothing fits
+    """
+    if not accept:
+        return renderers[0] if renderers else None
+    ranges = parse_accept(accept)
+    refused = [media_range for media_range, q in ranges if q <= 0]
+    for media_range, q in ranges:
+        if q <= 0:
+            break
+        for renderer in renderers:
+            if renderer.matches(media_range) and not any(renderer.matches(r) for r in refused if '*' not in r):
+                return renderer
+    return None
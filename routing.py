@@ -0,0 +1,175 @@
+"""
+Read replica routing for BaseManager.
+
+    WEB_API_READ_REPLICAS = ['replica_1', 'replica_2']
+    WEB_API_REPLICA_STRATEGY = 'round_robin'     # or 'least_lag'
+    WEB_API_REPLICA_MAX_LAG = 10                  # seconds, least_lag skips replicas that are further behind
+    WEB_API_REPLICA_LAG_TTL = 1                   # seconds between lag checks of a replica
+
+Manager reads go to a replica, writes go to the primary. After a write
+(model save/delete signals or BaseManager writes) the rest of the request
+reads from the primary too, so the client sees its own changes. Reads inside
+a transaction of the primary and select_for_update() reads stay on the primary.
+`use_primary` forces the primary for a view. The writes are remembered until
+the end of the `scope()` (BaseWebApi.method) or of the request (request_started
+signal), wrap other jobs (commands, tasks) in `scope()`.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.core.signals import request_started
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+logger = logging.getLogger('error_server')
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LAG = 'least_lag'
+
+_local = threading.local()
+_counter = itertools.count()
+_lags = {}
+
+
+def reset():
+    """
+    forget the writes of the previous request
+    """
+    _local.wrote = set()
+    _local.primary = 0
+
+
+@contextmanager
+def scope():
+    """
+    routing of one request or job, its writes are forgotten when it ends
+    """
+    reset()
+    try:
+        yield
+    finally:
+        reset()
+
+
+def get_state():
+    return set(getattr(_local, 'wrote', None) or ()), getattr(_local, 'primary', 0)
+
+
+def set_state(state):
+    """
+    continue the routing of another thread (BaseService.fan_out)
+    """
+    _local.wrote, _local.primary = set(state[0]), state[1]
+
+
+def mark_write(using=DEFAULT_DB_ALIAS):
+    wrote = getattr(_local, 'wrote', None)
+    if wrote is None:
+        wrote = _local.wrote = set()
+    wrote.add(using or DEFAULT_DB_ALIAS)
+
+
+def has_written(using=DEFAULT_DB_ALIAS):
+    return using in (getattr(_local, 'wrote', None) or ())
+
+
+@contextmanager
+def primary():
+    """
+    every manager read inside the block goes to the primary
+    """
+    _local.primary = getattr(_local, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary -= 1
+
+
+def use_primary(view_func):
+    @wraps(view_func)
+    def _wrapped_view_func(*args, **kwargs):
+        with primary():
+            return view_func(*args, **kwargs)
+    return _wrapped_view_func
+
+
+def get_replicas(replicas=None):
+    if replicas is None:
+        replicas = getattr(settings, 'WEB_API_READ_REPLICAS', ())
+    return [alias for alias in replicas if alias in connections.databases]
+
+
+def measure_lag(alias):
+    """
+    replication lag in seconds, None when the replica can't be reached
+    """
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT CASE WHEN pg_is_in_recovery() THEN "
+                               "COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+                               "ELSE 0 END")
+                return float(cursor.fetchone()[0])
+            elif connection.vendor == 'mysql':
+                cursor.execute("SHOW SLAVE STATUS")
+                row = cursor.fetchone()
+                if row is None:
+                    return 0.0
+                names = [column[0] for column in cursor.description]
+                lag = dict(zip(names, row)).get('Seconds_Behind_Master')
+                return None if lag is None else float(lag)
+    except Exception:
+        logger.exception("Replica lag check of '%s' failed", alias)
+        return None
+    return 0.0
+
+
+def get_lag(alias):
+    ttl = getattr(settings, 'WEB_API_REPLICA_LAG_TTL', 1)
+    checked = _lags.get(alias)
+    now = time.time()
+    if checked is None or now - checked[0] > ttl:
+        checked = _lags[alias] = (now, measure_lag(alias))
+    return checked[1]
+
+
+def select_replica(replicas, strategy=None):
+    strategy = strategy or getattr(settings, 'WEB_API_REPLICA_STRATEGY', ROUND_ROBIN)
+    if strategy == LEAST_LAG:
+        max_lag = getattr(settings, 'WEB_API_REPLICA_MAX_LAG', 10)
+        lags = [(lag, alias) for lag, alias in ((get_lag(alias), alias) for alias in replicas)
+                if lag is not None and lag <= max_lag]
+        return min(lags)[1] if lags else None
+    return replicas[next(_counter) % len(replicas)]
+
+
+def db_for_read(primary_alias=DEFAULT_DB_ALIAS, replicas=None, strategy=None):
+    """
+    alias for a read, the primary when forced, after a write, in a transaction or without healthy replicas
+    """
+    if getattr(_local, 'primary', 0) or has_written(primary_alias) or connections[primary_alias].in_atomic_block:
+        return primary_alias
+    replicas = get_replicas(replicas)
+    if not replicas:
+        return primary_alias
+    return select_replica(replicas, strategy) or primary_alias
+
+
+def _on_write(sender, using=None, **kwargs):
+    mark_write(using)
+
+
+def _on_request(sender, **kwargs):
+    reset()
+
+
+post_save.connect(_on_write, dispatch_uid='web_platform_routing_post_save')
+post_delete.connect(_on_write, dispatch_uid='web_platform_routing_post_delete')
+m2m_changed.connect(_on_write, dispatch_uid='web_platform_routing_m2m_changed')
+request_started.connect(_on_request, dispatch_uid='web_platform_routing_request_started')
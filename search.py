@@ -0,0 +1,186 @@
+"""
+Search backends for BaseManager.icontains.
+
+The backend is selected by the manager Meta:
+
+    class Meta:
+        search_backend = 'postgres'     # 'icontains', 'postgres', 'trigram', 'sqlite_fts' or a class / dotted path
+        search_config = 'english'       # postgres text search config
+        search_table = 'app_item_fts'   # sqlite fts5 table, default '<db_table>_fts'
+
+A backend that can't run on the current database falls back to 'icontains'.
+"""
+from functools import reduce
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+import six
+
+
+class BaseSearchBackend(object):
+    vendor = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def is_available(self, objects, fields):
+        return self.vendor is None or connections[objects.db].vendor == self.vendor
+
+    def search(self, objects, fields, value, operator="OR"):
+        raise NotImplementedError
+
+    @staticmethod
+    def combine(queries, operator="OR"):
+        return reduce(lambda a, b: a & b if operator == "AND" else a | b, queries)
+
+    @staticmethod
+    def order_by_rank(objects):
+        if objects.query.order_by:
+            return objects
+        return objects.order_by('-search_rank')
+
+
+class IContainsSearchBackend(BaseSearchBackend):
+    """
+    OR/AND of `field__icontains` lookups, works everywhere
+    """
+
+    def search(self, objects, fields, value, operator="OR"):
+        return objects.filter(self.combine([Q(**{"%s__icontains" % field: value}) for field in fields], operator))
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    full text search ranked by ts_rank,
+    add a GIN index on the same SearchVector expression to avoid sequential scans
+    """
+    vendor = 'postgresql'
+
+    def search(self, objects, fields, value, operator="OR"):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        config = self.options.search_config
+        words = value.split()
+        if operator == "AND" or len(words) < 2:
+            query = SearchQuery(value, config=config)
+        else:
+            query = self.combine([SearchQuery(word, config=config) for word in words], operator)
+        vector = SearchVector(*fields, config=config)
+        objects = objects.annotate(search_vector=vector).filter(search_vector=query)
+        if self.options.search_rank:
+            objects = self.order_by_rank(objects.annotate(search_rank=SearchRank(vector, query)))
+        return objects
+
+
+class TrigramSearchBackend(BaseSearchBackend):
+    """
+    pg_trgm similarity, uses GIN/GiST trigram indexes on the fields
+    """
+    vendor = 'postgresql'
+
+    def search(self, objects, fields, value, operator="OR"):
+        from django.contrib.postgres.search import TrigramSimilarity
+        from django.db.models.functions import Greatest
+        objects = objects.filter(self.combine([Q(**{"%s__trigram_similar" % field: value}) for field in fields],
+                                              operator))
+        if self.options.search_rank:
+            similarities = [TrigramSimilarity(field, value) for field in fields]
+            rank = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+            objects = self.order_by_rank(objects.annotate(search_rank=rank))
+        return objects
+
+
+class SqliteFtsSearchBackend(BaseSearchBackend):
+    """
+    prebuilt FTS5 index (see build_index), for local development and tests
+    """
+    vendor = 'sqlite'
+    # {(alias, table): exists}, shared by the instances, updated by build_index
+    _tables = {}
+
+    def get_table(self, model):
+        return self.options.search_table or "%s_fts" % model._meta.db_table
+
+    def is_available(self, objects, fields):
+        if not super(SqliteFtsSearchBackend, self).is_available(objects, fields):
+            return False
+        if any('__' in field for field in fields):
+            return False
+        key = (objects.db, self.get_table(objects.model))
+        if key not in self._tables:
+            self._tables[key] = key[1] in connections[objects.db].introspection.table_names()
+        return self._tables[key]
+
+    @staticmethod
+    def quote_term(term):
+        """
+        prefix query of the word, as icontains finds 'item' in 'items'
+        """
+        return '"%s"*' % term.replace('"', '""')
+
+    def search(self, objects, fields, value, operator="OR"):
+        model = objects.model
+        table = self.get_table(model)
+        columns = " ".join(model._meta.get_field(field).column for field in fields)
+        terms = (" %s " % operator).join(self.quote_term(word) for word in value.split())
+        if not terms:
+            return objects
+        match = "{%s} : (%s)" % (columns, terms)
+        pk = '"%s"."%s"' % (model._meta.db_table, model._meta.pk.column)
+        # pk__in=RawSQL(...) is rendered as IN ((...)) which sqlite reads as a scalar subquery
+        objects = objects.extra(where=['%s IN (SELECT rowid FROM "%s" WHERE "%s" MATCH %%s)' % (pk, table, table)],
+                                params=[match])
+        if self.options.search_rank:
+            rank = RawSQL('SELECT -rank FROM "%s" WHERE "%s" MATCH %%s AND rowid = %s' % (table, table, pk), [match])
+            objects = self.order_by_rank(objects.annotate(search_rank=rank))
+        return objects
+
+    def build_index(self, model, fields, using='default'):
+        """
+        create (or rebuild) an external content fts5 table over `fields` kept in sync by triggers
+        """
+        table = self.get_table(model)
+        source = model._meta.db_table
+        pk = model._meta.pk.column
+        # a failed build leaves the table to be checked again
+        self._tables.pop((using, table), None)
+        columns = [model._meta.get_field(field).column for field in fields]
+        column_list = ", ".join('"%s"' % c for c in columns)
+        new_values = ", ".join('new."%s"' % c for c in columns)
+        old_values = ", ".join('old."%s"' % c for c in columns)
+        with connections[using].cursor() as cursor:
+            # triggers of a previous build may list other fields
+            for suffix in ('ai', 'ad', 'au'):
+                cursor.execute('DROP TRIGGER IF EXISTS "%s_%s"' % (table, suffix))
+            cursor.execute('DROP TABLE IF EXISTS "%s"' % table)
+            cursor.execute('CREATE VIRTUAL TABLE "%s" USING fts5(%s, content="%s", content_rowid="%s")'
+                           % (table, column_list, source, pk))
+            cursor.execute('INSERT INTO "%s"("%s") VALUES (\'rebuild\')' % (table, table))
+            cursor.execute('CREATE TRIGGER "%s_ai" AFTER INSERT ON "%s" BEGIN '
+                           'INSERT INTO "%s"(rowid, %s) VALUES (new."%s", %s); END'
+                           % (table, source, table, column_list, pk, new_values))
+            cursor.execute('CREATE TRIGGER "%s_ad" AFTER DELETE ON "%s" BEGIN '
+                           'INSERT INTO "%s"("%s", rowid, %s) VALUES (\'delete\', old."%s", %s); END'
+                           % (table, source, table, table, column_list, pk, old_values))
+            cursor.execute('CREATE TRIGGER "%s_au" AFTER UPDATE ON "%s" BEGIN '
+                           'INSERT INTO "%s"("%s", rowid, %s) VALUES (\'delete\', old."%s", %s); '
+                           'INSERT INTO "%s"(rowid, %s) VALUES (new."%s", %s); END'
+                           % (table, source, table, table, column_list, pk, old_values,
+                              table, column_list, pk, new_values))
+        self._tables[(using, table)] = True
+
+
+SEARCH_BACKENDS = {
+    'icontains': IContainsSearchBackend,
+    'postgres': PostgresSearchBackend,
+    'trigram': TrigramSearchBackend,
+    'sqlite_fts': SqliteFtsSearchBackend,
+}
+
+
+def get_search_backend(options):
+    backend = options.search_backend or 'icontains'
+    if isinstance(backend, six.string_types):
+        backend = SEARCH_BACKENDS[backend] if backend in SEARCH_BACKENDS else import_string(backend)
+    return backend(options)
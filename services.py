@@ -1,11 +1,22 @@
+from collections import OrderedDict
+from operator import attrgetter
+import hashlib
 import os
+import threading
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.db import models
+from django.core.cache import caches
+from django.db import connections, models
 from django.db.models import QuerySet
-from django.db.models.fields.files import ImageFieldFile, FieldFile
-from django.db.models.fields.related import ManyToManyField
+from django.db.models.fields.files import FileField, FieldFile
+from django.db.models.query import ModelIterable
+from django.utils.encoding import force_bytes
 import six
 
+from utils.web_platform import profiler, routing, timing
+from utils.web_platform.columnar import Columnar
+from utils.web_platform.errors import exception
+
 
 class ResourceOptions(object):
     method_allowed = ()
@@ -31,6 +42,263 @@ class DeclarativeMetaclass(type):
         return new_class
 
 
+FILE_CHECK_EXISTS = 'exists'
+FILE_CHECK_TRUST = 'trust'
+FILE_CHECK_BATCH = 'batch'
+FILE_CACHE_CHUNK_SIZE = 500
+
+_stat_pool = None
+_fan_out_pool = None
+_fan_out_lock = threading.Lock()
+_fan_out_local = threading.local()
+
+
+def get_file_check_mode():
+    """
+    settings.WEB_API_FILE_CHECK:
+    'exists' - check the file through the storage, results are cached
+    'trust' - never touch the storage, size only if it is already cached
+    'batch' - as 'exists' with parallel stats of the files missing in the cache
+    lists read the cache with one round trip per FILE_CACHE_CHUNK_SIZE files in every mode
+    """
+    return getattr(settings, 'WEB_API_FILE_CHECK', FILE_CHECK_EXISTS)
+
+
+def file_cache_key(storage, name):
+    source = "%s.%s:%s:%s" % (storage.__class__.__module__, storage.__class__.__name__,
+                              getattr(storage, 'location', ''), name)
+    return 'web_api:file:%s' % hashlib.md5(force_bytes(source)).hexdigest()
+
+
+def stat_file(storage, name):
+    try:
+        if not storage.exists(name):
+            return False
+        return {'size': storage.size(name)}
+    except (OSError, IOError, NotImplementedError):
+        return False
+
+
+def stat_files(storage, names, parallel=True):
+    global _stat_pool
+    workers = getattr(settings, 'WEB_API_FILE_STAT_WORKERS', 8)
+    if not parallel or len(names) < 2 or workers < 2:
+        return [stat_file(storage, name) for name in names]
+    if _stat_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _stat_pool = ThreadPoolExecutor(max_workers=workers)
+    return list(_stat_pool.map(lambda name: stat_file(storage, name), names))
+
+
+def get_files_metadata(storage, names, stat=True, parallel=True):
+    """
+    {name: {'size': size} or None if the file doesn't exist or isn't cached and not `stat`}
+    names missing in the cache are checked through the storage when `stat`,
+    one get_many and one set_many per FILE_CACHE_CHUNK_SIZE names
+    """
+    cache = caches[getattr(settings, 'WEB_API_FILE_CACHE', 'default')]
+    names = list(OrderedDict.fromkeys(names))
+    metadata = {}
+    for start in range(0, len(names), FILE_CACHE_CHUNK_SIZE):
+        chunk = names[start:start + FILE_CACHE_CHUNK_SIZE]
+        keys = dict((file_cache_key(storage, name), name) for name in chunk)
+        metadata.update((keys[key], value or None) for key, value in cache.get_many(list(keys.keys())).items())
+        missing = [name for name in chunk if name not in metadata]
+        if missing and stat:
+            stats = stat_files(storage, missing, parallel)
+            cache.set_many(dict((file_cache_key(storage, name), value) for name, value in zip(missing, stats)),
+                           getattr(settings, 'WEB_API_FILE_CACHE_TTL', 300))
+            metadata.update((name, value or None) for name, value in zip(missing, stats))
+        else:
+            metadata.update((name, None) for name in missing)
+    return metadata
+
+
+class FileConverter(object):
+    """
+    FieldFile (or the stored name) to {'url', 'size', 'name', 'filename'}
+    size_index - position of a '<field>_size' column stored alongside the row,
+    then the file is trusted and the storage is never asked
+    """
+
+    def __init__(self, field, size_index=None):
+        self.storage = field.storage
+        self.size_index = size_index
+
+    @staticmethod
+    def get_name(value):
+        return value.name if isinstance(value, FieldFile) else value
+
+    def prefetch(self, values):
+        if self.size_index is not None:
+            return None
+        mode = get_file_check_mode()
+        return get_files_metadata(self.storage, [name for name in map(self.get_name, values) if name],
+                                  stat=mode != FILE_CHECK_TRUST, parallel=mode == FILE_CHECK_BATCH)
+
+    def __call__(self, value, row, metadata=None):
+        name = self.get_name(value)
+        if not name:
+            return None
+        if self.size_index is not None:
+            size = row[self.size_index]
+        else:
+            mode = get_file_check_mode()
+            if metadata is None or name not in metadata:
+                metadata = get_files_metadata(self.storage, [name], stat=mode != FILE_CHECK_TRUST)
+            info = metadata.get(name)
+            if info is None and mode != FILE_CHECK_TRUST:
+                return None
+            size = info['size'] if info else None
+        return {
+            'url': self.storage.url(name),
+            'size': size,
+            'name': name,
+            'filename': os.path.basename(name)
+        }
+
+
+class ModelSerializer(object):
+    """
+    model_to_dict compiled once per (model, fields, exclude)
+    """
+
+    def __init__(self, model, fields=None, exclude=None, files=True):
+        self.names = []
+        self.attnames = []
+        self.converters = []
+        concrete_fields = model._meta.concrete_fields
+        field_names = dict((f.name, f) for f in concrete_fields)
+        size_fields = []
+        for f in concrete_fields:
+            if fields and f.name not in fields:
+                continue
+            if exclude and f.name in exclude:
+                continue
+            if files and isinstance(f, FileField):
+                size_field = field_names.get("%s_size" % f.name)
+                if size_field is not None:
+                    size_fields.append((len(self.converters), size_field))
+                self.converters.append((len(self.names), FileConverter(f)))
+            self.names.append(f.name)
+            self.attnames.append(f.attname)
+        # size columns are read after the output columns, zip() with names skips them
+        for converter_index, size_field in size_fields:
+            self.converters[converter_index][1].size_index = len(self.attnames)
+            self.attnames.append(size_field.attname)
+        if len(self.attnames) > 1:
+            self.getter = attrgetter(*self.attnames)
+        elif self.attnames:
+            getter = attrgetter(self.attnames[0])
+            self.getter = lambda instance: (getter(instance),)
+        else:
+            self.getter = lambda instance: ()
+
+    def to_dict(self, values, metadata=None):
+        if self.converters:
+            row = values
+            values = list(values)
+            for index, convert in self.converters:
+                values[index] = convert(row[index], row, metadata.get(index) if metadata else None)
+        return dict(zip(self.names, values))
+
+    def __call__(self, instance):
+        return self.to_dict(self.getter(instance))
+
+    def many(self, rows):
+        """
+        rows - tuples of attnames values
+        """
+        metadata = None
+        if self.converters:
+            rows = list(rows)
+            metadata = dict((index, convert.prefetch([row[index] for row in rows]))
+                            for index, convert in self.converters)
+        return [self.to_dict(row, metadata) for row in rows]
+
+    def from_instances(self, instances):
+        return self.many([self.getter(instance) for instance in instances])
+
+    def from_queryset(self, queryset):
+        """
+        fetch only the columns as tuples instead of building model instances
+        """
+        if not self.attnames:
+            return [{} for ii in queryset]
+        return self.many(queryset.values_list(*self.attnames))
+
+
+_serializers = {}
+
+
+def get_model_serializer(model, fields=None, exclude=None, files=True):
+    key = (model, frozenset(fields) if fields else None, frozenset(exclude) if exclude else None, files)
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = _serializers[key] = ModelSerializer(model, fields, exclude, files)
+    return serializer
+
+
+class FanOutTask(object):
+    """
+    a task of BaseService.fan_out, `started` - timing.clock() when a thread picked it up
+    """
+
+    def __init__(self, key, func, limit):
+        self.key = key
+        self.func = func
+        self.limit = limit
+        self.started = None
+        self.future = None
+
+    def is_late(self, now):
+        return self.limit is not None and self.started is not None and not self.future.done() and \
+            now >= self.started + self.limit
+
+    def deadline(self):
+        if self.limit is None or self.started is None or self.future.done():
+            return None
+        return self.started + self.limit
+
+
+def get_fan_out_pool(workers):
+    """
+    the executor shared by every fan_out of the process, replaced when settings.WEB_API_FAN_OUT_WORKERS changes
+    """
+    global _fan_out_pool
+    with _fan_out_lock:
+        if _fan_out_pool is None or _fan_out_pool[0] != workers:
+            from concurrent.futures import ThreadPoolExecutor
+            if _fan_out_pool is not None:
+                _fan_out_pool[1].shutdown(wait=False)
+            _fan_out_pool = (workers, ThreadPoolExecutor(max_workers=workers))
+        return _fan_out_pool[1]
+
+
+def run_task(task, state, changed):
+    """
+    task.func() in a fan_out thread with the routing, timing and query profile of the caller,
+    the thread's connections are closed when it's done
+    """
+    routing_state, timer, profile = state
+    task.started = timing.clock()
+    with changed:
+        changed.notify()
+    _fan_out_local.worker = True
+    routing.set_state(routing_state)
+    timing.attach(timer)
+    if profile is not None:
+        profiler.attach(profile)
+    try:
+        return task.func()
+    finally:
+        profiler.stop()
+        timing.attach(None)
+        routing.reset()
+        connections.close_all()
+        _fan_out_local.worker = False
+
+
 class BaseService(six.with_metaclass(DeclarativeMetaclass)):
     def __init__(self, user=None):
         self.user = user or AnonymousUser()
@@ -39,7 +307,67 @@ class BaseService(six.with_metaclass(DeclarativeMetaclass)):
         self.user = user
         return self
 
+    def fan_out(self, tasks, timeout=None, timeouts=None):
+        """
+        run independent calls (manager counts, pages, aggregates) at the same time
+        tasks - {name: callable} or [callable], results come back in the same shape
+        timeout - seconds for every task, timeouts - {name: seconds} per task,
+        a late task raises ServiceTimeout, an exception of a task is raised as is,
+        the timeout of a task counts from the moment a thread starts it
+
+        The tasks of all the calls of the process share settings.WEB_API_FAN_OUT_WORKERS
+        (default 8) threads, so there are never more threads and connections than that.
+        A late task isn't interrupted, it finishes in the background and holds its thread
+        until then, tasks of the caller which haven't started yet are cancelled.
+        Each task uses its own database connection, so it doesn't see the uncommitted
+        changes of the caller's transaction.
+        """
+        named = isinstance(tasks, dict)
+        items = list(tasks.items()) if named else list(enumerate(tasks))
+        workers = getattr(settings, 'WEB_API_FAN_OUT_WORKERS', 8)
+        if len(items) < 2 or workers < 2 or getattr(_fan_out_local, 'worker', False):
+            results = [(key, func()) for key, func in items]
+            return dict(results) if named else [result for key, result in results]
+
+        executor = get_fan_out_pool(workers)
+        state = (routing.get_state(), timing.current(), profiler.current())
+        tasks = [FanOutTask(key, func, (timeouts or {}).get(key, timeout)) for key, func in items]
+        changed = threading.Condition()
+
+        def notify(future):
+            with changed:
+                changed.notify()
+
+        try:
+            for task in tasks:
+                task.future = executor.submit(run_task, task, state, changed)
+                task.future.add_done_callback(notify)
+            with changed:
+                while True:
+                    for task in tasks:
+                        if task.future.done() and task.future.exception() is not None:
+                            raise task.future.exception()
+                    if all(task.future.done() for task in tasks):
+                        break
+                    now = timing.clock()
+                    # the time a task waits for a free thread doesn't count against its timeout
+                    for task in tasks:
+                        if task.is_late(now):
+                            raise exception.ServiceTimeout(u"Task '%s' timed out" % (task.key,))
+                    deadlines = [deadline for deadline in (task.deadline() for task in tasks) if deadline is not None]
+                    changed.wait(max(0, min(deadlines) - now) if deadlines else None)
+        finally:
+            for task in tasks:
+                if task.future is not None:
+                    task.future.cancel()
+        results = [(task.key, task.future.result()) for task in tasks]
+        return dict(results) if named else [result for key, result in results]
+
     def unpack_model_objects(self, obj):
+        if isinstance(obj, QuerySet) and self.can_unpack_values(obj):
+            return get_model_serializer(obj.model).from_queryset(obj)
+        if isinstance(obj, (list, set)) and self.can_unpack_instances(obj):
+            return get_model_serializer(type(next(iter(obj)))).from_instances(obj)
         if isinstance(obj, (list, set, QuerySet)):
             items = []
             for ii in obj:
@@ -48,6 +376,28 @@ class BaseService(six.with_metaclass(DeclarativeMetaclass)):
         else:
             return self.unpack_model_object(obj)
 
+    def can_unpack_values(self, queryset):
+        """
+        values_list can be used when the queryset isn't loaded yet, yields models
+        and the service doesn't customize unpacking
+        """
+        return queryset._result_cache is None and queryset._iterable_class is ModelIterable and \
+            self.has_default_unpack()
+
+    def can_unpack_instances(self, objects):
+        """
+        instances of one model are serialized together, so file metadata is resolved in one batch
+        """
+        if not objects or not self.has_default_unpack():
+            return False
+        model = type(next(iter(objects)))
+        return issubclass(model, models.Model) and all(type(ii) is model for ii in objects)
+
+    def has_default_unpack(self):
+        cls = type(self)
+        return cls.unpack_model_object is BaseService.unpack_model_object and \
+            cls.model_to_dict is BaseService.model_to_dict
+
     def unpack_model_object(self, obj):
         if isinstance(obj, models.Model):
             item = self.model_to_dict(obj)
@@ -58,45 +408,11 @@ class BaseService(six.with_metaclass(DeclarativeMetaclass)):
     def model_to_dict(instance, fields=None, exclude=None):
         if not instance:
             return
-        opts = instance._meta
-        data = {}
-        for f in opts.concrete_fields + opts.many_to_many:
-            # if not getattr(f, 'editable', False):
-            #    continue
-            if fields and f.name not in fields:
-                continue
-            if exclude and f.name in exclude:
-                continue
-            if isinstance(f, ManyToManyField):
-                continue
-            else:
-                value = f.value_from_object(instance)
-                if isinstance(value, ImageFieldFile) or isinstance(value, FieldFile):
-                    value = {
-                        'url': value.url,
-                        'size': value.size,
-                        'name': value.name,
-                        'filename': os.path.basename(value.name)
-                    } if value and os.path.exists(value.path) and value.name else None
-                data[f.name] = value
-        return data
+        return get_model_serializer(type(instance), fields, exclude)(instance)
 
     @staticmethod
     def user_model_to_dict(instance, fields=None, exclude=None):
-        opts = instance._meta
-        data = {}
-        for f in opts.concrete_fields + opts.many_to_many:
-            if not getattr(f, 'editable', False):
-                pass
-            if fields and not f.name in fields:
-                continue
-            if exclude and f.name in exclude:
-                continue
-            if isinstance(f, ManyToManyField):
-                continue
-            else:
-                data[f.name] = f.value_from_object(instance)
-        return data
+        return get_model_serializer(type(instance), fields, exclude, files=False)(instance)
 
     @staticmethod
     def resource_format(data=None):
@@ -111,7 +427,7 @@ class BaseService(six.with_metaclass(DeclarativeMetaclass)):
         page_objects = []
         if isinstance(objects, QuerySet):
             count = objects.count()
-        elif isinstance(objects, list):
+        elif isinstance(objects, (list, Columnar)):
             count = objects.__len__()
         if count > 0:
             page_objects = objects[(page - 1) * per_page: page * per_page]
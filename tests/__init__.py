@@ -0,0 +1,12 @@
+"""
+Regression tests, run from the checkout against the in-memory settings of the benchmarks:
+
+    python -m unittest discover -s tests -t .
+"""
+from benchmarks.run import setup
+
+setup()
+
+from utils.web_platform.benchmarks import cases  # noqa
+
+cases.create_tables()
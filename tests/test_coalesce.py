@@ -0,0 +1,24 @@
+from unittest import TestCase
+
+from django.http import HttpResponse
+
+from utils.web_platform import coalesce
+
+
+class FreezeTest(TestCase):
+    def test_request_headers_stripped(self):
+        response = HttpResponse('{}', content_type='application/json')
+        response['Server-Timing'] = 'total;dur=1.00'
+        response['X-Query-Count'] = '2'
+        response['Vary'] = 'Accept'
+        shared = coalesce.thaw(coalesce.freeze(response))
+        self.assertNotIn('Server-Timing', shared)
+        self.assertNotIn('X-Query-Count', shared)
+        self.assertEqual(shared['Vary'], 'Accept')
+        self.assertEqual(shared['Content-Type'], 'application/json')
+
+    def test_only_success_and_redirects(self):
+        for status in (200, 204, 301, 304):
+            self.assertIsNotNone(coalesce.freeze(HttpResponse(status=status)))
+        for status in (400, 404, 429, 500, 503):
+            self.assertIsNone(coalesce.freeze(HttpResponse(status=status)))
@@ -0,0 +1,59 @@
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from utils.web_platform import export
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.webapi import BaseWebApi, response_mapping
+
+
+class ItemApi(BaseWebApi):
+    counted = None
+    top = None
+
+    @response_mapping(cases.ItemMapping, mapping_path='data', export=True)
+    def items(self, request):
+        ItemApi.top = list(cases.ItemManager().order('-id').limit(0, 1).to_data())
+        manager = cases.ItemManager().order('id')
+        ItemApi.counted = manager.count()
+        manager.limit(0, 2)
+        return {'data': manager.to_data(), 'total': ItemApi.counted}
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        cases.populate(5)
+        self.view = ItemApi().method('items')
+
+    def test_export_whatever_the_accept_header(self):
+        for format, accept in (('csv', 'text/csv'), ('ndjson', 'application/x-ndjson'),
+                               ('csv', 'application/x-ndjson'), ('ndjson', 'text/csv')):
+            response = self.view(RequestFactory().get('/items', {'export': format}, HTTP_ACCEPT=accept))
+            self.assertEqual(response.status_code, 200)
+            lines = b''.join(response.streaming_content).splitlines()
+            self.assertEqual(len(lines), 6 if format == 'csv' else 5)
+            self.assertEqual(response['Vary'], 'Accept')
+
+    def test_export_keeps_the_other_reads(self):
+        self.view(RequestFactory().get('/items', {'export': 'ndjson'}))
+        self.assertEqual(ItemApi.counted, 5)
+        self.assertEqual(len(ItemApi.top), 1)
+        self.view(RequestFactory().get('/items'))
+        self.assertEqual(ItemApi.counted, 5)
+
+    @override_settings(WEB_API_EXPORT_CHUNK_SIZE=2)
+    def test_export_streams_chunks_with_one_query(self):
+        response = self.view(RequestFactory().get('/items', {'export': 'ndjson'}))
+        with CaptureQueriesContext(connection) as queries:
+            chunks = [chunk.count(b'\n') for chunk in response.streaming_content]
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(len(queries), 1)
+
+    def test_export_rows_are_lazy(self):
+        with export.exporting(export.NDJSON):
+            with CaptureQueriesContext(connection) as queries:
+                rows = cases.ItemManager().order('id').limit(0, 2).to_data()
+            self.assertIsInstance(rows, export.ExportRows)
+            self.assertEqual(len(queries), 0)
+            self.assertEqual(len(list(rows)), 2)
+            self.assertEqual(len(list(export.unpaged(rows))), 5)
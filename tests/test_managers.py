@@ -0,0 +1,99 @@
+from django.db import IntegrityError
+from django.db.models import QuerySet
+from django.test import TestCase
+
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.benchmarks.models import BenchGroup, BenchItem
+from utils.web_platform.managers import BaseManager
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class GroupManager(BaseManager):
+    def __init__(self):
+        super(GroupManager, self).__init__(['id', 'name', 'code'])
+        self.objects = BenchGroup.objects.all()
+
+
+class UpsertTest(TestCase):
+    def test_created_ids(self):
+        result = GroupManager().upsert([{'code': 'A', 'name': 'a'}, {'code': 'B', 'name': 'b'}], ['code'])
+        self.assertEqual([outcome['id'] for outcome in result],
+                         [BenchGroup.objects.get(code=code).pk for code in ('A', 'B')])
+
+    def test_pk_in_items(self):
+        group = BenchGroup.objects.create(code='A', name='a')
+        result = GroupManager().upsert([{'pk': group.pk, 'code': 'A', 'name': 'a2'}], ['code'])
+        self.assertEqual(result[0]['status'], 'updated')
+        self.assertEqual(BenchGroup.objects.get(pk=group.pk).name, 'a2')
+
+    def test_concurrent_insert(self):
+        # another worker inserts the key between the select and the insert
+        BenchGroup.objects.create(code='A', name='other')
+        manager = GroupManager()
+        get_existing = manager.get_existing
+        bulk_create = QuerySet.bulk_create
+
+        def first_select(*args):
+            manager.get_existing = get_existing
+            return {}
+
+        def conflict(queryset, *args, **kwargs):
+            QuerySet.bulk_create = bulk_create
+            raise IntegrityError('UNIQUE constraint failed: code')
+
+        manager.get_existing = first_select
+        with mock.patch.object(QuerySet, 'bulk_create', conflict):
+            result = manager.upsert([{'code': 'A', 'name': 'a'}], ['code'])
+        self.assertEqual(result[0]['status'], 'updated')
+        self.assertEqual(list(BenchGroup.objects.values_list('code', 'name')), [('A', 'a')])
+
+
+class FieldsTest(TestCase):
+    def test_only(self):
+        manager = cases.ItemManager().only(cases.ItemMapping(None).sparse_fieldset(['title']))
+        self.assertEqual(manager.fields, ['title'])
+        self.assertEqual(manager.related_fields, ())
+        manager = cases.ItemManager().only(cases.ItemMapping(None).sparse_fieldset(['id', 'group']))
+        self.assertEqual(manager.fields, ['id'])
+        self.assertEqual([rel_field[0] for rel_field in manager.related_fields], ['group'])
+
+    def test_expand(self):
+        manager = cases.ItemManager().expand(cases.ItemMapping(None).expansion([]))
+        self.assertEqual(manager.related_fields, ())
+        manager = cases.ItemManager().expand(cases.ItemMapping(None).expansion(['group']))
+        self.assertEqual([rel_field[0] for rel_field in manager.related_fields], ['group'])
+
+
+class QueryChainTest(TestCase):
+    def setUp(self):
+        cases.populate(6)
+        self.base = cases.ItemManager().chain().filter(is_active=True)
+
+    def test_chains_dont_share_state(self):
+        titles = self.base.only(cases.ItemMapping(None).sparse_fieldset(['title']))
+        recent = self.base.filter(quantity__gte=3)
+        self.assertEqual(titles._state.fields, ['title'])
+        self.assertEqual(recent._state.fields, cases.FIELDS)
+        self.assertEqual(self.base._state.fields, cases.FIELDS)
+        self.assertEqual(sorted(list(titles.to_data())[0]), ['title'])
+        self.assertEqual(recent.count(), BenchItem.objects.filter(is_active=True, quantity__gte=3).count())
+        self.assertEqual(self.base.count(), BenchItem.objects.filter(is_active=True).count())
+        self.assertIsNot(titles._state.objects, recent._state.objects)
+        self.assertNotIn('quantity" >=', str(self.base._state.objects.query))
+
+    def test_sql_memoized_per_alias(self):
+        chain = self.base.cached(60)
+        manager = chain.get_manager()
+        manager.compiled = chain._compiled
+        get_sql = mock.Mock(side_effect=lambda objects, using: ('SELECT %s' % using, ()))
+        with mock.patch.object(cases.ItemManager, 'get_sql', get_sql):
+            primary = manager.compile('rows', manager.objects.using('default'))
+            self.assertEqual(manager.compile('rows', manager.objects.using('default')), primary)
+            replica = manager.compile('rows', manager.objects.using('replica'))
+        self.assertEqual(primary, ('SELECT default', ()))
+        self.assertEqual(replica, ('SELECT replica', ()))
+        self.assertEqual(get_sql.call_count, 2)
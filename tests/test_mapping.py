@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+from django.db import connection
+from django.test import TestCase as DjangoTestCase
+from django.test.utils import CaptureQueriesContext
+
+from utils.web_platform import mapping
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.benchmarks.models import BenchGroup, BenchItem
+from utils.web_platform.webapi import JsonEncoder
+
+
+class EncodeJsonTest(TestCase):
+    def setUp(self):
+        self.encode = JsonEncoder(sort_keys=True, ensure_ascii=False).encode
+
+    def assertSameJson(self, data):
+        self.assertEqual(cases.ItemMapping(None).encode_json(data, self.encode),
+                         self.encode(cases.ItemMapping(None).encode(data)))
+
+    def test_rows(self):
+        self.assertSameJson(cases.make_rows(mapping.JSON_CHUNK_SIZE * 2 + 1))
+
+    def test_generator(self):
+        rows = cases.make_rows(mapping.JSON_CHUNK_SIZE + 1)
+        self.assertEqual(cases.ItemMapping(None).encode_json((row for row in rows), self.encode),
+                         self.encode(cases.ItemMapping(None).encode(rows)))
+
+    def test_item_and_empty(self):
+        self.assertSameJson(cases.make_rows(1)[0])
+        self.assertSameJson([])
+        self.assertSameJson(None)
+
+
+def load_groups(keys):
+    return dict((group['id'], group) for group in BenchGroup.objects.filter(id__in=keys).values('id', 'name', 'code'))
+
+
+class LoadedItemMapping(mapping.BaseMapping):
+    group = mapping.MappingResourceField(cases.GroupMapping, loader=load_groups, key='group_id')
+    tags = mapping.MappingResourceField(cases.GroupMapping)
+
+    class Meta:
+        fields = {"id": "id"}
+        # exposed names differ from the item keys
+        resource_fields = {"groupInfo": "group", "tagList": "tags"}
+
+
+class LoaderTest(DjangoTestCase):
+    def setUp(self):
+        cases.populate(6)
+        self.rows = list(BenchItem.objects.values('id', 'group_id'))
+
+    def test_one_query_per_loader(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = LoadedItemMapping(None).encode(self.rows)
+        self.assertEqual(len(queries), 1)
+        groups = dict(BenchGroup.objects.values_list('id', 'name'))
+        self.assertEqual([item['groupInfo']['name'] for item in data], [groups[row['group_id']] for row in self.rows])
+
+    def test_loaded_once_per_context(self):
+        with mapping.batch_context():
+            LoadedItemMapping(None).encode(self.rows)
+            with CaptureQueriesContext(connection) as queries:
+                LoadedItemMapping(None).encode(self.rows[:2])
+        self.assertEqual(len(queries), 0)
+
+    def test_resource_lists(self):
+        rows = [{'id': 1, 'group_id': None, 'tags': [{'id': 2, 'name': 'a', 'code': 'A'}]}]
+        self.assertEqual(LoadedItemMapping(None).encode(rows),
+                         [{'id': 1, 'groupInfo': None, 'tagList': [{'id': 2, 'name': 'a', 'code': 'A'}]}])
@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+
+from utils.web_platform import query_cache
+from utils.web_platform.benchmarks.models import BenchGroup, BenchItem
+
+
+class QueryCacheTest(TestCase):
+    def setUp(self):
+        query_cache.get_local_cache().clear()
+        self.labels = query_cache.watch([BenchItem])
+
+    def test_reads_get_copies(self):
+        value = query_cache.get_or_set(('copies',), lambda: [{'id': 1}], 60, self.labels)
+        value[0]['id'] = 2
+        cached = query_cache.get_or_set(('copies',), lambda: None, 60, self.labels)
+        cached.append({'id': 3})
+        self.assertEqual(query_cache.get_or_set(('copies',), lambda: None, 60, self.labels), [{'id': 1}])
+
+    def test_invalidated_again_on_commit(self):
+        with transaction.atomic():
+            query_cache.invalidate(BenchItem)
+            # a result cached before the commit, e.g. by another worker
+            query_cache.get_or_set(('commit',), lambda: 'old', 60, self.labels)
+        self.assertEqual(query_cache.get_or_set(('commit',), lambda: 'new', 60, self.labels), 'new')
+
+    @override_settings(WEB_API_QUERY_CACHE='default')
+    def test_shared_cache_invalidated_by_unwatched_writers(self):
+        label = query_cache.get_label(BenchGroup)
+        # a worker which writes the model and never reads it through the cache
+        query_cache._watched.discard(label)
+        labels = [label]
+        query_cache.get_or_set(('writer',), lambda: 'old', 60, labels)
+        post_save.send(sender=BenchGroup, instance=BenchGroup(id=1, name='a'), created=False, using='default')
+        self.assertTrue(caches['default'].get(query_cache.generation_key(label)))
+        self.assertEqual(query_cache.get_or_set(('writer',), lambda: 'new', 60, labels), 'new')
@@ -0,0 +1,89 @@
+from django.db.models import Q
+from django.test import TestCase
+
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.benchmarks.models import BenchGroup, BenchItem
+from utils.web_platform.errors.exception import ValidationError
+from utils.web_platform.managers import BaseManager
+from utils.web_platform.query_parser import LARGE_IN_SIZE, parse_filter
+from utils.web_platform.validation import validate_filter
+
+
+class LargeInTest(TestCase):
+    def setUp(self):
+        cases.populate(20)
+        self.manager = BaseManager()
+        self.manager.objects = BenchItem.objects.all()
+
+    def test_foreign_key_ids(self):
+        ids = [group.pk for group in BenchGroup.objects.all()[:3]] + list(range(100000, 100000 + LARGE_IN_SIZE))
+        self.manager.filter(group__in=ids)
+        self.assertEqual(self.manager.objects.count(), BenchItem.objects.filter(group_id__in=ids[:3]).count())
+
+    def test_foreign_key_instances(self):
+        groups = list(BenchGroup.objects.all()[:2]) * (LARGE_IN_SIZE + 1)
+        self.manager.filter(group__in=groups)
+        self.assertEqual(self.manager.objects.count(), BenchItem.objects.filter(group__in=groups[:2]).count())
+
+    def test_filter_plan(self):
+        ids = [str(group.pk) for group in BenchGroup.objects.all()[:1]] + [str(i) for i in range(LARGE_IN_SIZE + 1)]
+        self.manager.query(parse_filter('group:%s' % '|'.join(ids)).to_q())
+        self.assertEqual(self.manager.objects.count(), BenchItem.objects.filter(group_id__in=ids).count())
+
+
+class ValidatedPlanTest(TestCase):
+    def test_plan_key_includes_mapping(self):
+        @validate_filter({'id': {'type': 'integer', 'is_array': True}})
+        def view(cls_obj, data):
+            return data['filter']
+
+        raw = 'a:1|2,b:3'
+        first = view(None, {'filter': parse_filter(raw).remap({'id': 'a'})})
+        second = view(None, {'filter': parse_filter(raw).remap({'id': 'b'})})
+        self.assertEqual(first['id'], [1, 2])
+        self.assertEqual(second['id'], [3])
+
+    def test_copies_dont_share_values(self):
+        @validate_filter({'id': {'type': 'integer', 'is_array': True}})
+        def view(cls_obj, data):
+            return data['filter']
+
+        view(None, {'filter': parse_filter('id:1|2')})['id'].append(3)
+        self.assertEqual(view(None, {'filter': parse_filter('id:1|2')})['id'], [1, 2])
+
+    def test_scalar_option_keeps_scalar_lookup(self):
+        @validate_filter({'id': {'type': 'integer'}})
+        def view(cls_obj, data):
+            return data['filter']
+
+        plan = view(None, {'filter': parse_filter('id:1|2')})
+        self.assertEqual(plan['id'], 1)
+        self.assertEqual(str(plan.to_q()), str(Q(id=1)))
+
+    def test_unsupported_clause_rejected(self):
+        @validate_filter({'id': {'type': 'integer', 'is_array': True}})
+        def view(cls_obj, data):
+            return data['filter']
+
+        for raw, code in (('itemId:>1', 'operator'), ('!itemId:1', 'negate')):
+            with self.assertRaises(ValidationError) as raised:
+                view(None, {'filter': parse_filter(raw).remap({'id': 'itemId'})})
+            self.assertEqual(raised.exception.fields['itemId']['code'], code)
+
+    def test_to_q_allows_operators(self):
+        @validate_filter({'id': {'type': 'integer', 'is_array': True}}, to_q=True)
+        def view(cls_obj, data):
+            return data['filter']
+
+        plan = view(None, {'filter': parse_filter('itemId:>1,!itemId:3').remap({'id': 'itemId'})})
+        self.assertEqual(str(plan.to_q()), str(Q(id__gt=1) & ~Q(id=3)))
+
+    def test_errors_keyed_by_client_names(self):
+        @validate_filter({'id': {'type': 'integer', 'is_array': True}}, to_q=True)
+        def view(cls_obj, data):
+            return data['filter']
+
+        for raw in ('itemId:abc', 'itemId:>abc'):
+            with self.assertRaises(ValidationError) as raised:
+                view(None, {'filter': parse_filter(raw).remap({'id': 'itemId'})})
+            self.assertEqual(list(raised.exception.fields), ['itemId'])
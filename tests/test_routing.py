@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from django.db import transaction
+
+from utils.web_platform import routing
+from utils.web_platform.benchmarks import cases
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class RoutingTest(TestCase):
+    def setUp(self):
+        routing.reset()
+        routing._lags.clear()
+        patcher = mock.patch.object(routing, 'get_replicas', lambda replicas=None: ['replica'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_your_writes(self):
+        with routing.scope():
+            self.assertEqual(routing.db_for_read(), 'replica')
+            routing.mark_write()
+            self.assertEqual(routing.db_for_read(), 'default')
+        # the next request reads from the replica again
+        self.assertEqual(routing.db_for_read(), 'replica')
+
+    def test_primary_in_transaction(self):
+        with transaction.atomic():
+            self.assertEqual(routing.db_for_read(), 'default')
+        self.assertEqual(routing.db_for_read(), 'replica')
+
+    def test_select_for_update_on_primary(self):
+        manager = cases.ItemManager()
+        self.assertEqual(manager.read_objects(manager.objects).db, 'replica')
+        self.assertEqual(manager.read_objects(manager.objects.select_for_update()).db, 'default')
+
+    def test_unhealthy_replicas_skipped(self):
+        lags = {'replica_1': None, 'replica_2': 30, 'replica_3': 2}
+        with mock.patch.object(routing, 'measure_lag', lags.get):
+            self.assertEqual(routing.select_replica(['replica_1', 'replica_2', 'replica_3'], routing.LEAST_LAG),
+                             'replica_3')
+            self.assertIsNone(routing.select_replica(['replica_1', 'replica_2'], routing.LEAST_LAG))
+            self.assertEqual(routing.db_for_read(strategy=routing.LEAST_LAG), 'default')
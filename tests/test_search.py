@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from django.db import connection
+
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.benchmarks.models import BenchItem
+from utils.web_platform.search import SqliteFtsSearchBackend
+
+TABLE = 'test_search_item_fts'
+
+
+class FtsItemManager(cases.ItemManager):
+    class Meta:
+        search_backend = 'sqlite_fts'
+        search_table = TABLE
+
+
+def drop_index():
+    # virtual tables don't take part in the savepoints of django.test.TestCase
+    with connection.cursor() as cursor:
+        for suffix in ('ai', 'ad', 'au'):
+            cursor.execute('DROP TRIGGER IF EXISTS "%s_%s"' % (TABLE, suffix))
+        cursor.execute('DROP TABLE IF EXISTS "%s"' % TABLE)
+    SqliteFtsSearchBackend._tables.pop(('default', TABLE), None)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        cases.populate(3)
+        BenchItem.objects.filter(title='Item 1').update(title='Red apples')
+        self.addCleanup(drop_index)
+
+    def titles(self, manager):
+        return sorted(manager.objects.values_list('title', flat=True))
+
+    def test_icontains(self):
+        self.assertEqual(self.titles(cases.ItemManager().search('title', value='apple')), ['Red apples'])
+        self.assertEqual(self.titles(cases.ItemManager().search('title', 'description', value='item 2')),
+                         ['Item 2'])
+
+    def test_sqlite_fts_prefix(self):
+        FtsItemManager().build_search_index('title', 'description')
+        self.assertEqual(self.titles(FtsItemManager().search('title', value='appl')), ['Red apples'])
+        self.assertEqual(self.titles(FtsItemManager().search('title', 'description', value='red item')),
+                         ['Item 0', 'Item 2', 'Red apples'])
+        self.assertEqual(self.titles(FtsItemManager().search('title', value='red apple', operator="AND")),
+                         ['Red apples'])
+
+    def test_sqlite_fts_table_built_after_the_check(self):
+        objects = BenchItem.objects.all()
+        self.assertFalse(FtsItemManager().get_search_backend().is_available(objects, ['title']))
+        # without the index the search falls back to icontains
+        self.assertEqual(self.titles(FtsItemManager().search('title', value='apple')), ['Red apples'])
+        FtsItemManager().build_search_index('title')
+        self.assertTrue(FtsItemManager().get_search_backend().is_available(objects, ['title']))
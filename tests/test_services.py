@@ -0,0 +1,91 @@
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test.utils import override_settings
+
+from utils.web_platform.columnar import Columnar
+from utils.web_platform.errors import exception
+from utils.web_platform.services import BaseService, FileConverter, FILE_CACHE_CHUNK_SIZE, FILE_CHECK_EXISTS, \
+    FILE_CHECK_TRUST
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def sleep(value, seconds):
+    def func():
+        time.sleep(seconds)
+        return value
+    return func
+
+
+class FanOutTest(TestCase):
+    @override_settings(WEB_API_FAN_OUT_WORKERS=2)
+    def test_timeout_counts_from_start(self):
+        # the third task waits for a thread longer than its timeout
+        tasks = [sleep(1, 0.2), sleep(2, 0.2), sleep(3, 0.2)]
+        self.assertEqual(BaseService().fan_out(tasks, timeout=0.3), [1, 2, 3])
+
+    def test_late_task(self):
+        with self.assertRaises(exception.ServiceTimeout):
+            BaseService().fan_out({'a': sleep(1, 0), 'b': sleep(2, 1)}, timeouts={'b': 0.1})
+        # the late task holds one of the threads until it's done
+        self.assertEqual(BaseService().fan_out({'a': sleep(1, 0), 'b': sleep(2, 0)}, timeout=0.5), {'a': 1, 'b': 2})
+
+    @override_settings(WEB_API_FAN_OUT_WORKERS=3)
+    def test_threads_shared_by_the_calls(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def task():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return True
+
+        def call():
+            BaseService().fan_out([task, task, task])
+
+        callers = [threading.Thread(target=call) for i in range(4)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertLessEqual(running[1], 3)
+
+
+class PagingTest(TestCase):
+    def test_columnar(self):
+        data = Columnar(['id'], [(1,), (2,), (3,)])
+        paging = BaseService.objects_to_paging(data, page=2, per_page=2)
+        self.assertEqual(paging['count'], 3)
+        self.assertEqual(paging['data'].envelope(), {'fields': ['id'], 'columns': [[3]]})
+
+
+class FileMetadataTest(TestCase):
+    def setUp(self):
+        self.storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.storage.save('a.txt', ContentFile(b'12345'))
+        caches['default'].clear()
+
+    def test_one_cache_round_trip_per_chunk(self):
+        names = ['a.txt'] + ['missing%s.txt' % i for i in range(FILE_CACHE_CHUNK_SIZE)]
+        cache = caches['default']
+        for mode in (FILE_CHECK_EXISTS, FILE_CHECK_TRUST):
+            with override_settings(WEB_API_FILE_CHECK=mode), \
+                    mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                converter = FileConverter(mock.Mock(storage=self.storage))
+                metadata = converter.prefetch(names)
+                values = [converter(name, (), metadata) for name in names]
+            self.assertEqual(get_many.call_count, 2)
+            self.assertEqual(values[0]['size'], 5 if mode == FILE_CHECK_EXISTS else None)
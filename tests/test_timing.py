@@ -0,0 +1,27 @@
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+
+from utils.web_platform import profiler, timing
+from utils.web_platform.benchmarks.models import BenchItem
+from utils.web_platform.webapi import BaseWebApi
+
+
+class CountApi(BaseWebApi):
+    def items(self, request):
+        return {'count': BenchItem.objects.count()}
+
+
+class FinishTest(TestCase):
+    @override_settings(WEB_API_SERVER_TIMING=True, WEB_API_QUERY_PROFILER=True,
+                       WEB_API_QUERY_PROFILER_MODE='raise', WEB_API_QUERY_MAX_COUNT=0)
+    def test_timing_finished_when_profiler_raises(self):
+        finished = []
+        hook = timing.register_hook(lambda request, response, timer: finished.append(response))
+        try:
+            with self.assertRaises(profiler.QueryBudgetExceeded):
+                CountApi().method('items')(RequestFactory().get('/items'))
+        finally:
+            timing._hooks.remove(hook)
+        self.assertEqual(len(finished), 1)
+        self.assertIn('Server-Timing', finished[0])
+        self.assertIsNone(timing.current())
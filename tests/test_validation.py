@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from utils.web_platform import validation
+from utils.web_platform.benchmarks.models import BenchItem
+from utils.web_platform.errors.exception import ValidationError
+from utils.web_platform.validation import get_model_indexed_fields, OrderPlan
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class OrderPlanTest(TestCase):
+    fields = ['id', 'title', 'group', 'group_id', 'group__id', 'group__pk', 'group__name', 'missing']
+
+    def test_indexed_fields(self):
+        self.assertTrue(set(['id', 'pk', 'group', 'group_id']) <= get_model_indexed_fields(BenchItem))
+
+    def test_attnames_and_paths(self):
+        plan = OrderPlan(self.fields, model=BenchItem, unindexed='reject')
+        for field in ('id', 'group', 'group_id', 'group__id', 'group__pk'):
+            self.assertEqual(plan.validate([{field: 'desc'}]), [{field: 'desc'}])
+        for field in ('title', 'group__name', 'missing'):
+            with self.assertRaises(ValidationError):
+                plan.validate([{field: 'asc'}])
+
+    def test_unknown_row_count_is_a_small_table(self):
+        plan = OrderPlan(self.fields, model=BenchItem, unindexed='reject', large_table_rows=1000)
+        with mock.patch.object(validation, 'estimate_row_count', return_value=None):
+            self.assertEqual(plan.validate([{'title': 'asc'}]), [{'title': 'asc'}])
+        with mock.patch.object(validation, 'estimate_row_count', return_value=5000):
+            with self.assertRaises(ValidationError):
+                plan.validate([{'title': 'asc'}])
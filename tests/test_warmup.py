@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from utils.web_platform import warmup
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.webapi import BaseWebApi
+
+
+class ItemApi(BaseWebApi):
+    def items(self, request):
+        return []
+
+    def items_add(self, request):
+        return {}
+
+
+class WarmUpTest(TestCase):
+    def test_register_once(self):
+        func = lambda: 1
+        warmup.register('test', func)
+        warmup.register('test', func)
+        self.assertEqual(warmup._tasks.pop('test'), [func])
+
+    def test_resource_registered_once_per_class(self):
+        for _ in range(3):
+            ItemApi().method('items')
+        self.assertEqual(warmup._tasks['resources'].count(ItemApi.warm_up), 1)
+        self.assertEqual(ItemApi.warm_up(), 1)
+        self.assertEqual(ItemApi._meta.handlers[('items', 'post')], 'items_add')
+
+    def test_mapping_fields_built_once(self):
+        cases.ItemMapping.warm_up()
+        meta_fields = cases.ItemMapping._meta.meta_fields
+        mapping = cases.ItemMapping(None)
+        self.assertIs(cases.ItemMapping._meta.meta_fields, meta_fields)
+        self.assertEqual(mapping.encode_fields, meta_fields[1])
+        self.assertIsNot(mapping.encode_fields, meta_fields[1])
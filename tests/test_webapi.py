@@ -0,0 +1,78 @@
+import json
+from unittest import TestCase
+
+from django.test import RequestFactory
+
+from utils.web_platform.benchmarks import cases
+from utils.web_platform.errors.exception import ValidationError
+from utils.web_platform.webapi import BaseWebApi, expand_fields, mapping, sparse_fields
+
+
+class MappingErrorsTest(TestCase):
+    def test_only_field_names_remapped(self):
+        @mapping(full_name='fullName', address={'key': 'addr', 'params': {'zip_code': 'zip'}})
+        def view(cls_obj, request):
+            raise ValidationError(detail=u"invalid", fields={
+                'full_name': {'message': u"required", 'code': 'required', 'max_length': {'min_length': 1}},
+                'address': {'message': u"invalid", 'code': 'type'},
+                'other_field': {'message': u"invalid"}})
+
+        request = type('Request', (object,), {'data': {}})()
+        with self.assertRaises(ValidationError) as raised:
+            view(None, request)
+        self.assertEqual(raised.exception.fields, {
+            'fullName': {'message': u"required", 'code': 'required', 'max_length': {'min_length': 1}},
+            'addr': {'message': u"invalid", 'code': 'type'},
+            'otherField': {'message': u"invalid"}})
+
+
+class NegotiationApi(BaseWebApi):
+    def item(self, request):
+        return {'id': 1}
+
+
+class NegotiationTest(TestCase):
+    def setUp(self):
+        self.view = NegotiationApi().method('item')
+
+    def test_default_renderer_without_accept(self):
+        for accept in (None, '*/*', 'text/html, */*;q=0.1'):
+            headers = {'HTTP_ACCEPT': accept} if accept is not None else {}
+            response = self.view(RequestFactory().get('/item', **headers))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_not_acceptable(self):
+        response = self.view(RequestFactory().get('/item', HTTP_ACCEPT='text/html'))
+        self.assertEqual(response.status_code, 406)
+        self.assertIn('application/json', json.loads(response.content.decode('utf-8'))['available'])
+
+
+@sparse_fields(cases.ItemMapping)
+@expand_fields(cases.ItemMapping)
+def fields_view(cls_obj, request):
+    return request.sparse_fields, request.expand
+
+
+class FieldsParamsTest(TestCase):
+    def parse(self, request):
+        BaseWebApi().convert_request_data(request)
+        return fields_view(None, request)
+
+    def test_query_string(self):
+        fieldset, expansion = self.parse(RequestFactory().get('/items', {'fields': 'id,isActive,group',
+                                                                          'expand': 'group'}))
+        self.assertEqual(fieldset.fields, frozenset(['id', 'is_active']))
+        self.assertEqual(fieldset.resources, frozenset(['group']))
+        self.assertEqual(expansion.names, ['group'])
+
+    def test_form_body_lists(self):
+        fieldset, expansion = self.parse(RequestFactory().post('/items', {'fields': ['id', 'title,group'],
+                                                                          'expand': ['group']}))
+        self.assertEqual(fieldset.fields, frozenset(['id', 'title']))
+        self.assertEqual(expansion.names, ['group'])
+
+    def test_body_not_an_object(self):
+        fieldset, expansion = self.parse(RequestFactory().post('/items', '[1, 2]', content_type='application/json'))
+        self.assertIsNone(fieldset)
+        self.assertEqual(expansion.names, [])
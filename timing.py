@@ -0,0 +1,150 @@
+"""
+Per-request stage timings.
+
+Stages are recorded into a thread local timer that only exists while
+a request with timing enabled is being processed, so every `stage` and
+`timed` call is a single attribute lookup when timing is off.
+The collected durations are sent back in the `Server-Timing` header and
+passed to the registered hooks (metrics, logs, ...).
+"""
+from functools import wraps
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+import six
+
+logger = logging.getLogger('error_server')
+
+_local = threading.local()
+_hooks = []
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class RequestTimer(object):
+    def __init__(self):
+        self.names = []
+        self.durations = {}
+        self.started = clock()
+        # fan_out threads add their stages to the timer of the request
+        self.lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self.lock:
+            if name not in self.durations:
+                self.names.append(name)
+                self.durations[name] = 0.0
+            self.durations[name] += duration
+
+    @property
+    def stages(self):
+        """
+        list of (name, milliseconds) in the order the stages were first seen
+        """
+        return [(name, self.durations[name] * 1000) for name in self.names]
+
+    @property
+    def total(self):
+        return (clock() - self.started) * 1000
+
+    def header(self):
+        items = ["%s;dur=%.2f" % (name, dur) for name, dur in self.stages]
+        items.append("total;dur=%.2f" % self.total)
+        return ", ".join(items)
+
+
+class stage(object):
+    """
+    with stage('db'):
+        ...
+    """
+    __slots__ = ('name', 'timer', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.timer = None
+        self.started = None
+
+    def __enter__(self):
+        self.timer = getattr(_local, 'timer', None)
+        if self.timer is not None:
+            self.started = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timer is not None:
+            self.timer.add(self.name, clock() - self.started)
+        return False
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def _wrapped_func(*args, **kwargs):
+            timer = getattr(_local, 'timer', None)
+            if timer is None:
+                return func(*args, **kwargs)
+            started = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.add(name, clock() - started)
+        return _wrapped_func
+    return decorator
+
+
+def register_hook(func):
+    """
+    func(request, response, timer) is called after each timed request
+    """
+    if func not in _hooks:
+        _hooks.append(func)
+    return func
+
+
+def get_hooks():
+    hooks = list(_hooks)
+    for path in getattr(settings, 'WEB_API_TIMING_HOOKS', ()):
+        hooks.append(import_string(path) if isinstance(path, six.string_types) else path)
+    return hooks
+
+
+def is_enabled(enabled=None):
+    if enabled is None:
+        return getattr(settings, 'WEB_API_SERVER_TIMING', False)
+    return enabled
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+def attach(timer):
+    """
+    record the stages of this thread into `timer` of another thread, None to detach
+    """
+    _local.timer = timer
+    return timer
+
+
+def start(enabled=None):
+    timer = RequestTimer() if is_enabled(enabled) else None
+    _local.timer = timer
+    return timer
+
+
+def finish(request, response):
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return response
+    _local.timer = None
+    response['Server-Timing'] = timer.header()
+    for hook in get_hooks():
+        try:
+            hook(request, response, timer)
+        except Exception:
+            logger.exception("Server timing hook %r failed", hook)
+    return response
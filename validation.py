@@ -1,17 +1,24 @@
 # coding=utf-8
+from collections import OrderedDict
 from decimal import Decimal
 from functools import wraps
 import datetime
+import time
 from django.core.validators import RegexValidator
 from django.utils.dateparse import parse_datetime, parse_date
 
 from django.core import exceptions, validators
+from django.db import connections, router
 from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-import phonenumbers
 import re
 from utils.web_platform.errors.exception import ValidationError
+from utils.web_platform.query_parser import FilterPlan, FilterTerm, PlanCache
+from utils.web_platform import timing, warmup
+
+
+FILTER_MAX_VALUES = 10000
 
 
 def decode_to_type(value, types):
@@ -49,6 +56,7 @@ def decode_to_date(value):
     raise ValidationError(_(u"Не валидные входные данные"))
 
 
+@timing.timed('validation')
 def validate_fields(data, options):
     if data is None:
         data = dict()
@@ -61,7 +69,42 @@ def validate_fields(data, options):
     return data
 
 
+def warm_up_validator(validator):
+    """
+    import and compile what a validator builds on its first call
+    """
+    if isinstance(validator, dict):
+        for item in validator['validators']:
+            warm_up_validator(item)
+        return
+    if validator is None:
+        return
+    if hasattr(validator, 'warm_up'):
+        validator.warm_up()
+    # lazily compiled regexes of the django validators
+    for name in ('regex', 'user_regex', 'domain_regex', 'literal_regex'):
+        regex = getattr(validator, name, None)
+        if regex is not None:
+            regex.pattern
+    if getattr(validator, 'message', None) is not None:
+        force_text(validator.message)
+
+
+def warm_up_fields(options):
+    """
+    create the validators of validate_input `options` as for a filled form
+    """
+    for name, params in options.items():
+        validator = ValidParam(name)
+        validator.create_validators(dict((key, True) for key in options), **params)
+        for item in validator.validators:
+            warm_up_validator(item)
+    return len(options)
+
+
 def validate_input(options):
+    warmup.register('validate_input', lambda: warm_up_fields(options))
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, data=None, *args, **kwargs):
@@ -73,48 +116,152 @@ def validate_input(options):
     return decorator
 
 
-def validate_filter(options):
+def get_decode_types(type_val):
+    if type_val == 'integer':
+        return [int]
+    elif type_val == 'bool':
+        return [int, bool]
+    elif type_val == 'datetime':
+        return [datetime.datetime]
+    elif type_val == 'date':
+        return [datetime.date]
+    return [str]
+
+
+def decode_values(values, decode_types):
+    """
+    decode_to_type of every value, repeated values are dropped
+    """
+    if decode_types == [int] and None not in values:
+        decoded = map(int, values)
+    elif decode_types == [str] and None not in values:
+        decoded = map(str, values)
+    else:
+        decoded = (decode_to_type(value, decode_types) for value in values)
+    return list(OrderedDict.fromkeys(decoded))
+
+
+def get_max_values(params):
+    return params.get('max_values', getattr(settings, 'WEB_API_FILTER_MAX_VALUES', FILTER_MAX_VALUES))
+
+
+def check_max_values(name, values, params):
+    max_values = get_max_values(params)
+    if max_values is not None and len(values) > max_values:
+        raise ValidationError(detail=_(u"Не валидные входные данные"),
+                              fields={name: {'message': force_text(_(u"Too many values")),
+                                             'code': 'max_values', 'limit': max_values}})
+
+
+def validate_filter_plan(plan, options, validate_filter_params, to_q=False):
+    """
+    decode values of the parsed clauses, clauses without options are dropped
+    options may limit allowed operators by 'operators': ['eq', 'gt', 'gte', 'lt', 'lte', 'range', 'prefix', 'null']
+    to_q - the plan is read by to_q, otherwise clauses the dict view doesn't hold are rejected
+    errors are keyed by the names of the request (see filter_mapping)
+    """
+    default_error_message = _(u"Не валидные входные данные")
+    clauses = []
+    for clause in plan.clauses:
+        params = options.get(clause.key)
+        if params is None:
+            continue
+        name = plan.client_name(clause.key)
+        if not to_q and not plan.is_plain(clause):
+            raise ValidationError(detail=default_error_message,
+                                  fields={name: {'message': force_text(_(u"Operator not supported")),
+                                                 'code': 'negate' if clause.negate else 'operator'}})
+        decode_types = get_decode_types(params.get('type', 'str'))
+        operators = params.get('operators')
+        for term in clause.terms:
+            if (operators is not None and term.op not in operators) or \
+                    (term.op == 'prefix' and decode_types != [str]):
+                raise ValidationError(detail=default_error_message,
+                                      fields={name: {'message': force_text(_(u"Operator not allowed")),
+                                                     'code': term.op}})
+        check_max_values(name, clause.terms, params)
+        try:
+            # the values of the eq terms in one pass, without repeats
+            values = decode_values([term.value for term in clause.terms if term.op == 'eq'], decode_types)
+            if not params.get('is_array', False):
+                # a single value as in the dict view, to_q keeps the scalar lookup
+                values = values[:1]
+            terms = [FilterTerm('eq', value) for value in values]
+            for term in clause.terms:
+                if term.op == 'eq':
+                    continue
+                elif term.op == 'range':
+                    value = tuple(decode_to_type(val, decode_types) for val in term.value)
+                else:
+                    value = decode_to_type(term.value, decode_types)
+                terms.append(term._replace(value=value))
+        except (ValueError, TypeError, ValidationError):
+            raise ValidationError(detail=default_error_message,
+                                  fields={name: {'message': force_text(default_error_message),
+                                                 'code': 'type'}})
+        clauses.append(clause._replace(terms=tuple(terms)))
+    return FilterPlan(clauses, plan.raw, validate_filter_params, names=plan.names)
+
+
+def validate_filter(options, to_q=False):
+    """
+    to_q - the view reads the filter by FilterPlan.to_q (BaseManager.query), so negations
+    and operators are allowed, views reading the dict view get a ValidationError for them
+    """
+    validated_plans = PlanCache()
+    # plans are cached by the options and the plan key (raw string and mappings)
+    options_key = id(options)
+    # (name, is_array, decode types) of the options, built once
+    specs = [(name, params, params.get('is_array', False), get_decode_types(params.get('type', 'str')))
+             for name, params in options.items()]
+
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, data, *args, **kwargs):
+            with timing.stage('validation'):
+                data = _validate(data)
+            return view_func(cls_obj, data, *args, **kwargs)
+
+        def _validate(data):
             data = data or {}
             filter = data.get('filter')
             validate_filter_params = dict()
+            if isinstance(filter, FilterPlan):
+                plan_key = (options_key, filter.key)
+                plan = validated_plans.get(plan_key)
+                if plan is not None:
+                    data['filter'] = plan.copy()
+                    return data
+            client_name = filter.client_name if isinstance(filter, FilterPlan) else str
             if filter:
-                for name, params in options.items():
+                for name, params, is_array, decode_types in specs:
                     values = filter.get(name)
                     if not values:
                         continue
-                    is_array = params.get('is_array', False)
-                    type_val = params.get('type', 'str')
 
                     if is_array and isinstance(values, str):
                         values = [values]
                     elif not is_array and isinstance(values, list):
                         values = values[0]
 
-                    decode_types = [str]
-                    if type_val == 'integer':
-                        decode_types = [int]
-                    elif type_val == 'bool':
-                        decode_types = [int, bool]
-                    elif type_val == 'datetime':
-                        decode_types = [datetime.datetime]
-                    elif type_val == 'date':
-                        decode_types = [datetime.date]
+                    if isinstance(values, list):
+                        check_max_values(client_name(str(name)), values, params)
                     try:
-                        values = [decode_to_type(val, decode_types) for val in values] \
+                        values = decode_values(values, decode_types) \
                             if isinstance(values, list) else decode_to_type(values, decode_types)
                     except ValueError:
                         continue
                     except ValidationError as e:
                         raise ValidationError({
                             'message': _(u"Не валидные входные данные"),
-                            'fields': {str(name): {"message": e.message}}
+                            'fields': {client_name(str(name)): {"message": e.message}}
                         }, 1)
                     validate_filter_params[str(name)] = values
+            if isinstance(filter, FilterPlan):
+                plan = validate_filter_plan(filter, options, validate_filter_params, to_q)
+                validate_filter_params = validated_plans.set(plan_key, plan, filter.raw).copy()
             data['filter'] = validate_filter_params
-            return view_func(cls_obj, data, *args, **kwargs)
+            return data
 
         return _wrapped_view_func
 
@@ -126,30 +273,24 @@ def validate_order(*fields, **base_kwargs):
     format = 0 - with asc and desc
     format = 1 - with '-' or empty
     format = 2 - django order_by format
+
+    indexed - fields backed by an index, by default taken from `model` (see get_model_indexed_fields)
+    tie_breaker - unique field appended to the order for stable pagination, e.g. 'id'
+    unindexed - what to do with orderings by fields without index:
+        'allow' - keep them
+        'fallback' - drop them, if nothing left use the default order
+        'reject' - raise ValidationError
+    large_table_rows - with `model` apply `unindexed` only when the table estimate is larger
     """
+    plan = OrderPlan(fields, **base_kwargs)
+    warmup.register('validate_order', plan.warm_up)
 
     def decorator(view_func):
         @wraps(view_func)
         def _wrapped_view_func(cls_obj, data=None, *args, **kwargs):
-            format_item = base_kwargs.get('format', 0)
-            data = data or {}
-            default_order_items = list(map(lambda x: list(x.keys())[0], base_kwargs.get("default", [])))
-            order_items = data.get('order') or base_kwargs.get("default", [])
-            if not isinstance(order_items, list):
-                order_items = []
-            items = []
-            all_fields = list(fields) + default_order_items
-            for item in order_items or []:
-                field = list(item.keys())[0]
-                if not field in all_fields:
-                    continue
-                if format_item == 1:
-                    items.append({field: "-" if item[field] == "desc" else ""})
-                elif format_item == 2:
-                    items.append(("-" if item[field] == "desc" else "") + field)
-                else:
-                    items.append(item)
-            data['order'] = items
+            with timing.stage('validation'):
+                data = data or {}
+                data['order'] = plan.validate(data.get('order'))
             return view_func(cls_obj, data, *args, **kwargs)
 
         return _wrapped_view_func
@@ -157,6 +298,174 @@ def validate_order(*fields, **base_kwargs):
     return decorator
 
 
+ROW_ESTIMATE_TTL = 600
+_row_estimates = {}
+
+
+def estimate_row_count(model):
+    """
+    Planner estimate of the table size (PostgreSQL, MySQL), None when unknown.
+    Cached for ROW_ESTIMATE_TTL seconds.
+    """
+    table = model._meta.db_table
+    cached = _row_estimates.get(table)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    connection = connections[router.db_for_read(model)]
+    count = None
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)"
+    elif connection.vendor == 'mysql':
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        sql = None
+    if sql:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+            count = row[0] if row else None
+    _row_estimates[table] = (count, time.time() + ROW_ESTIMATE_TTL)
+    return count
+
+
+def get_model_indexed_fields(model):
+    """
+    names and attnames ('group', 'group_id') of the fields that are the leading column of an index:
+    primary key, unique, db_index and foreign keys, Meta.indexes, index_together, unique_together
+    and unique constraints
+    """
+    opts = model._meta
+    leading = [f for f in opts.concrete_fields if f.primary_key or f.unique or f.db_index]
+    names = [index.fields[0].lstrip('-') for index in opts.indexes if index.fields]
+    names += [together[0] for together in list(getattr(opts, 'index_together', ())) + list(opts.unique_together)
+              if together]
+    names += [constraint.fields[0] for constraint in getattr(opts, 'constraints', ())
+              if getattr(constraint, 'fields', None)]
+    for name in names:
+        try:
+            leading.append(opts.get_field(name))
+        except exceptions.FieldDoesNotExist:
+            pass
+    indexed = set()
+    for f in leading:
+        indexed.update((f.name, f.attname))
+        if f.primary_key:
+            indexed.add('pk')
+    return frozenset(indexed)
+
+
+def is_indexed_path(model, path):
+    """
+    an order by `path` ('group_id', 'group__id', 'group__code') can use an index: the field is
+    the leading column of an index of its model, a foreign key to the primary key is the column
+    of the foreign key
+    """
+    name, _, rest = path.partition('__')
+    opts = model._meta
+    try:
+        field = opts.pk if name == 'pk' else opts.get_field(name)
+    except exceptions.FieldDoesNotExist:
+        return False
+    if not rest:
+        return field.name in get_model_indexed_fields(model)
+    if not (field.many_to_one or field.one_to_one) or not field.concrete:
+        return False
+    target = field.target_field
+    if rest in ('pk', target.name, target.attname) and (rest != 'pk' or target.primary_key):
+        return field.name in get_model_indexed_fields(model)
+    return is_indexed_path(field.related_model, rest)
+
+
+class OrderPlan(object):
+    """
+    validate_order options compiled once when the decorator is applied
+    """
+    FORMAT_DIRECTION = 0
+    FORMAT_PREFIX = 1
+    FORMAT_DJANGO = 2
+
+    def __init__(self, fields, format=0, default=None, indexed=None, model=None, tie_breaker=None,
+                 unindexed='allow', large_table_rows=None):
+        if unindexed not in ('allow', 'fallback', 'reject'):
+            raise ValueError("unindexed must be 'allow', 'fallback' or 'reject'")
+        self.format = format
+        self.default = [(list(item.keys())[0], list(item.values())[0]) for item in default or []]
+        self.default_fields = frozenset(field for field, direction in self.default)
+        self.fields = frozenset(fields) | self.default_fields
+        self.model = model
+        self.tie_breaker = tie_breaker
+        self.unindexed = unindexed
+        self.large_table_rows = large_table_rows
+        self._indexed = frozenset(indexed) if indexed is not None else None
+        # {field: indexed} of the model paths, see is_indexed
+        self._paths = {}
+
+    @property
+    def indexed(self):
+        if self._indexed is None:
+            self._indexed = get_model_indexed_fields(self.model) if self.model else frozenset()
+        return self._indexed
+
+    def warm_up(self):
+        """
+        indexed fields of the model, the row estimate needs the database and stays lazy
+        """
+        self.indexed
+
+    def is_large_table(self):
+        """
+        an unknown estimate (sqlite, no statistics) is a small table
+        """
+        if self.model is None or self.large_table_rows is None:
+            return True
+        count = estimate_row_count(self.model)
+        return count is not None and count > self.large_table_rows
+
+    def is_indexed(self, field):
+        """
+        `indexed` names as given, the model fields are resolved by name, attname or '__' path
+        """
+        if field in self.default_fields or field in self.indexed:
+            return True
+        if self.model is None or self._paths.get(field) is not None:
+            return self._paths.get(field, False)
+        self._paths[field] = is_indexed_path(self.model, field)
+        return self._paths[field]
+
+    def check_indexes(self, items):
+        unindexed = [field for field, direction in items if not self.is_indexed(field)]
+        if not unindexed or not self.is_large_table():
+            return items
+        if self.unindexed == 'reject':
+            raise ValidationError(detail=_(u"Не валидные входные данные"), fields={
+                'order': {'message': force_text(_(u"Ordering by this field is not supported")), 'fields': unindexed}
+            })
+        return [item for item in items if item[0] not in unindexed] or list(self.default)
+
+    def validate(self, order_items):
+        requested = bool(order_items)
+        order_items = order_items or [dict([item]) for item in self.default]
+        if not isinstance(order_items, list):
+            order_items = []
+        items = []
+        for item in order_items:
+            field = list(item.keys())[0]
+            if field in self.fields:
+                items.append((field, item[field]))
+        if requested and items and self.unindexed != 'allow':
+            items = self.check_indexes(items)
+        if self.tie_breaker and self.tie_breaker not in [field for field, direction in items]:
+            items.append((self.tie_breaker, items[-1][1] if items else 'asc'))
+        return [self.format_item(field, direction) for field, direction in items]
+
+    def format_item(self, field, direction):
+        if self.format == self.FORMAT_PREFIX:
+            return {field: "-" if direction == "desc" else ""}
+        elif self.format == self.FORMAT_DJANGO:
+            return ("-" if direction == "desc" else "") + field
+        return {field: direction}
+
+
 class ValidParam(object):
     def __init__(self, name):
         self.validators = []
@@ -345,9 +654,10 @@ class PhoneNumberValidator(validators.BaseValidator):
     clean = lambda self, x: force_text(x)
     message = _('Enter a valid phone number.')
     code = 'invalid'
+    # names of phonenumbers.PhoneNumberFormat, phonenumbers is imported on the first check
     formats = {
-        "INTERNATIONAL": phonenumbers.PhoneNumberFormat.E164,
-        "NATIONAL": phonenumbers.PhoneNumberFormat.NATIONAL
+        "INTERNATIONAL": "E164",
+        "NATIONAL": "NATIONAL"
     }
     messages = {
         0: _(u"INVALID_COUNTRY_CODE"),
@@ -363,7 +673,15 @@ class PhoneNumberValidator(validators.BaseValidator):
         if not self.format in self.formats.keys():
             self.format = "INTERNATIONAL"
 
+    def warm_up(self):
+        """
+        import phonenumbers and parse a number, its metadata is loaded on first use
+        """
+        import phonenumbers
+        phonenumbers.parse('+74951234567', None)
+
     def __call__(self, value):
+        import phonenumbers
         cleaned = self.clean(value)
         try:
             phone = phonenumbers.parse(cleaned, None)
@@ -373,7 +691,8 @@ class PhoneNumberValidator(validators.BaseValidator):
         is_valid = phonenumbers.is_valid_number(phone)
         if not is_valid:
             raise exceptions.ValidationError(self.message, code=self.code, params={'show_value': cleaned})
-        return phonenumbers.format_number(phone, self.formats[self.format]) \
+        number_format = getattr(phonenumbers.PhoneNumberFormat, self.formats[self.format])
+        return phonenumbers.format_number(phone, number_format) \
             .replace(' ', '').replace('+', '').replace('-', '')
 
 
@@ -385,12 +704,23 @@ class DateTimeValidator(validators.BaseValidator):
     message = _('Enter a valid date.')
     code = 'invalid'
     ISO_8601 = 'iso-8601'
-    input_formats = list(settings.DATETIME_INPUT_FORMATS)  # formats.get_format_lazy('DATETIME_INPUT_FORMATS')
-    input_formats += [ISO_8601]
+    _input_formats = None
 
     def __init__(self):
         super(DateTimeValidator, self).__init__(limit_value=None)
 
+    @property
+    def input_formats(self):
+        """
+        settings.DATETIME_INPUT_FORMATS are read on first use, not at import
+        """
+        if DateTimeValidator._input_formats is None:
+            DateTimeValidator._input_formats = list(settings.DATETIME_INPUT_FORMATS) + [self.ISO_8601]
+        return DateTimeValidator._input_formats
+
+    def warm_up(self):
+        self.input_formats
+
     def __call__(self, value):
         cleaned = self.clean(value)
         parsed = None
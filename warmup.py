@@ -0,0 +1,91 @@
+"""
+Warm-up of what the first requests of a worker would build on demand.
+
+    # wsgi.py, after get_wsgi_application(), or gunicorn `on_starting` with preload_app = True
+    from utils.web_platform import warmup
+    report = warmup.warm_up(freeze=True)
+
+The urlconf is imported first, it creates the resources and applies their
+decorators, which register their own warm-ups. Then every registered
+warm-up runs: mapping and resource classes are resolved,
+validate_input validators created, optional modules imported, translations
+loaded. Warm-ups don't touch the database, so they are safe before fork.
+
+    WEB_API_WARMUP_URLCONF = True         # import the urlconf before the warm-ups
+
+Report - [{'name', 'count', 'errors', 'time'}], time in milliseconds.
+"""
+from collections import OrderedDict
+import gc
+import logging
+
+from django.conf import settings
+
+from utils.web_platform import timing
+
+logger = logging.getLogger('error_server')
+
+_tasks = OrderedDict()
+
+
+def register(name, func):
+    """
+    func() is run by warm_up, returns the number of warmed items or None for one,
+    registering the same func again does nothing
+    """
+    funcs = _tasks.setdefault(name, [])
+    if func not in funcs:
+        funcs.append(func)
+    return func
+
+
+def load_urlconf():
+    from django.urls import get_resolver
+    resolver = get_resolver()
+    return len(resolver.url_patterns)
+
+
+def load_translations():
+    if not settings.USE_I18N:
+        return 0
+    from django.utils import translation
+    with translation.override(settings.LANGUAGE_CODE):
+        translation.gettext('')
+    return 1
+
+
+def run(name, funcs):
+    count = errors = 0
+    started = timing.clock()
+    for func in funcs:
+        try:
+            result = func()
+        except Exception:
+            errors += 1
+            logger.exception("Warm-up '%s' failed", name)
+            continue
+        count += 1 if result is None else result
+    return {'name': name, 'count': count, 'errors': errors, 'time': round((timing.clock() - started) * 1000, 2)}
+
+
+def warm_up(names=None, freeze=False):
+    """
+    run the warm-ups (all or `names`) and return the report
+    freeze - move the warmed objects to the permanent gc generation (python 3.7+),
+    the collector then doesn't write to their pages and forked workers keep sharing them
+    """
+    report = []
+    if getattr(settings, 'WEB_API_WARMUP_URLCONF', True) and (names is None or 'urlconf' in names):
+        report.append(run('urlconf', [load_urlconf]))
+    # the urlconf registers the warm-ups of its resources
+    for name, funcs in list(_tasks.items()):
+        if names is None or name in names:
+            report.append(run(name, list(funcs)))
+    if freeze and hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    logger.info("Warm-up: %s", ", ".join("%(name)s %(count)s in %(time)s ms" % item for item in report))
+    return report
+
+
+register('translations', load_translations)
@@ -1,16 +1,22 @@
-from copy import copy
 import traceback
+from collections import OrderedDict
 from django.core.serializers import json
 from django.utils.functional import Promise
 import six
 import logging
 from django.conf import settings
-from django.http import HttpResponse
-from django.template import Template, RequestContext
+from django.http import HttpResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.csrf import csrf_exempt
 import types
 
 from utils.web_platform.errors import exception
+from utils.web_platform import coalesce, profiler, routing, timing, warmup
+from utils.web_platform.columnar import Columnar, get_layout
+from utils.web_platform import renderers
+from utils.web_platform import export as exports
+from utils.web_platform.mapping import batch_context
 import sys
 
 logger = logging.getLogger('error_server')
@@ -37,34 +43,79 @@ def method_allowed(*methods):
     return decorator
 
 
-def decode_data(params_mapping, data, exclude_params=None):
-    new_data = dict()
-    for key, value in params_mapping.items():
-        if isinstance(value, dict):
-            param_value = copy(value.get("params", {}))
-            value = data.get(value.get("key", None), None)
-            if value:
-                new_data[key] = decode_data(param_value, value, exclude_params)
+_camel_keys = {}
+
+
+def camelize(key):
+    new_key = _camel_keys.get(key)
+    if new_key is None:
+        key_components = [component.title() for component in key.split('_')]
+        new_key = key_components[0].lower() + "".join(key_components[1:]) \
+            if key_components.__len__() > 1 else key_components[0].lower()
+        if len(_camel_keys) > 10000:
+            _camel_keys.clear()
+        _camel_keys[key] = new_key
+    return new_key
+
+
+class DecodePlan(object):
+    """
+    params_mapping of the mapping decorator compiled once:
+    {key: 'param'} or {key: {'key': 'param', 'params': {...}}} for nested objects and lists of objects
+    """
+
+    def __init__(self, params_mapping, exclude_params=None):
+        self.exclude_params = exclude_params
+        self.params = []
+        self.nested = []
+        self.reverse = {}
+        for key, value in params_mapping.items():
+            if isinstance(value, dict):
+                self.nested.append((key, value.get("key", None), DecodePlan(value.get("params", {}), exclude_params)))
+                self.reverse[key] = value.get('key', 'undefined')
+            else:
+                self.params.append((key, value))
+                self.reverse[key] = value
+
+    def decode(self, data):
+        if isinstance(data, list):
+            return [self.decode(item) if isinstance(item, dict) else item for item in data]
+        get = data.get
+        if self.exclude_params is None:
+            new_data = dict((key, get(param)) for key, param in self.params)
         else:
-            if exclude_params is None:
-                new_data[key] = data.get(value, None)
-            elif value in data:
-                new_data[key] = data.get(value, None)
+            new_data = dict((key, get(param)) for key, param in self.params if param in data)
+        for key, param, plan in self.nested:
+            value = get(param)
+            if value:
+                new_data[key] = plan.decode(value)
+        return new_data
 
-    return new_data
+    def encode_errors(self, fields):
+        """
+        internal field names of validation errors back to the request names,
+        the errors ({'message', 'code', ...}) are kept as they are
+        """
+        return dict((self.reverse.get(key) or camelize(key), value) for key, value in fields.items())
+
+
+def decode_data(params_mapping, data, exclude_params=None):
+    return DecodePlan(params_mapping, exclude_params).decode(data)
 
 
 def mapping(exclude_params=None, **params_mapping):
+    plan = DecodePlan(params_mapping, exclude_params)
+
     def decorator(view_func):
         @six.wraps(view_func)
         def _wrapped_view_func(cls_obj, request, *args, **kwargs):
-            data = request.data or {}
-            request.data = decode_data(params_mapping, data, exclude_params)
+            request.data = plan.decode(request.data or {})
             try:
                 return view_func(cls_obj, request, *args, **kwargs)
             except exception.ValidationError as e:
-                if 'fields' in e.detail:
-                    e.detail['fields'] = BaseWebApi().mapping_data(e.detail['fields'], **params_mapping)
+                if e.fields:
+                    e.fields = plan.encode_errors(e.fields)
+                    e.create_info()
                 raise e
 
         return _wrapped_view_func
@@ -72,26 +123,181 @@ def mapping(exclude_params=None, **params_mapping):
     return decorator
 
 
-def response_mapping(cls, mapping_path=None, auto_encode=False):
+def get_names(request, param):
+    """
+    names of `param` given as 'a,b' or as a list of them (form body, json array),
+    a body that isn't an object has no names
+    """
+    data = request.data
+    values = data.get(param) if isinstance(data, dict) else None
+    if isinstance(values, six.string_types):
+        values = [values]
+    elif not isinstance(values, (list, tuple)):
+        return []
+    return [name for value in values if isinstance(value, six.string_types)
+            for name in value.split(',') if name]
+
+
+def sparse_fields(cls, param='fields'):
+    """
+    ?fields=id,name - validate the names against `cls` mapping and replace the param
+    by mapping.SparseFieldset with the internal names, response_mapping with the same
+    mapping encodes only the requested fields
+    """
+
+    def decorator(view_func):
+        @six.wraps(view_func)
+        def _wrapped_view_func(cls_obj, request, *args, **kwargs):
+            names = get_names(request, param)
+            request.sparse_fields = None
+            if names:
+                request.sparse_fields = cls(None).sparse_fieldset(names)
+                request.data[param] = request.sparse_fields
+            return view_func(cls_obj, request, *args, **kwargs)
+
+        return _wrapped_view_func
+
+    return decorator
+
+
+def expand_fields(cls, param='expand'):
+    """
+    ?expand=group,tags - validate the names against the expandable resources of `cls` mapping
+    (Meta.expandable) and replace the param by mapping.Expansion, without the param nothing
+    is expanded; the view passes it to BaseManager.expand and response_mapping with the same
+    mapping encodes only the expanded resources
+    """
+
+    def decorator(view_func):
+        @six.wraps(view_func)
+        def _wrapped_view_func(cls_obj, request, *args, **kwargs):
+            request.expand = cls(None).expansion(get_names(request, param))
+            if isinstance(request.data, dict):
+                request.data[param] = request.expand
+            return view_func(cls_obj, request, *args, **kwargs)
+
+        return _wrapped_view_func
+
+    return decorator
+
+
+def columnar_layout(param='layout'):
+    """
+    ?layout=columns|rows or Accept: application/vnd.columnar+json[;layout=rows]
+    request.columnar_layout is the requested layout or None, the view passes it to
+    BaseManager.to_data(layout=...) and response_mapping encodes the envelope
+    """
+
+    def decorator(view_func):
+        @six.wraps(view_func)
+        def _wrapped_view_func(cls_obj, request, *args, **kwargs):
+            request.columnar_layout = get_layout(request, param)
+            return view_func(cls_obj, request, *args, **kwargs)
+
+        return _wrapped_view_func
+
+    return decorator
+
+
+def response_mapping(cls, mapping_path=None, auto_encode=False, fused=False, stream=False, export=None):
     """
     if data doesn't have 'mapping_path' then data will mapped all
+
+    fused - write the json while mapping the rows (BaseMapping.iter_json), the response is
+    the same as without it but no intermediate mapped dicts are built
+    stream - with fused send a StreamingHttpResponse, one chunk per mapping.JSON_CHUNK_SIZE rows
+    export - True or formats ('ndjson', 'csv') allowed for `?export=`, the rows under
+    mapping_path are streamed as a file, see export.py
     """
+    export_formats = exports.FORMATS if export is True else tuple(export or ())
 
     def decorator(view_func):
         @six.wraps(view_func)
         def _wrapped_view_func(cls_obj, request, *args, **kwargs):
-            data = view_func(cls_obj, request, *args, **kwargs)
+            export_format = exports.get_format(request, formats=export_formats) if export_formats else None
+            if export_format is not None:
+                with exports.exporting(export_format):
+                    data = view_func(cls_obj, request, *args, **kwargs)
+            else:
+                data = view_func(cls_obj, request, *args, **kwargs)
+            fieldset = getattr(request, 'sparse_fields', None)
+            if fieldset is not None and fieldset.mapping_cls is not cls:
+                fieldset = None
+
+            expansion = getattr(request, 'expand', None)
+            if expansion is not None and expansion.mapping_cls is not cls:
+                expansion = None
+
+            def get_mapping(path):
+                mapping = cls(path)
+                if fieldset is not None:
+                    mapping.select(fieldset.names)
+                return mapping.expand(expansion) if expansion is not None else mapping
+
+            if export_format is not None and not isinstance(data, HttpResponseBase):
+                mapping = get_mapping(mapping_path)
+                rows = exports.unpaged(mapping.get_path_data(data) if isinstance(data, dict) else data)
+                return exports.export_response(rows, mapping, export_format, view_func.__name__,
+                                               request.GET.get('compress'), auto_encode)
+
+            renderer = getattr(request, 'renderer', None)
+            if fused and not isinstance(data, HttpResponseBase) and \
+                    (renderer is None or renderer.format == 'json') and \
+                    not (settings.DEBUG and 'debug' in request.GET.dict()):
+                chunks = fused_json(data, get_mapping)
+                if chunks is not None:
+                    content_type = renderer.media_type if renderer is not None else \
+                        getattr(getattr(cls_obj, '_meta', None), 'default_format', 'application/json')
+                    if stream:
+                        return StreamingHttpResponse(chunks, content_type=content_type)
+                    with timing.stage('mapping'):
+                        content = ''.join(chunks)
+                    return HttpResponse(content, content_type=content_type)
+
+            if isinstance(data, Columnar):
+                return get_mapping(None).encode(data)
             if data and mapping_path:
                 try:
                     input_data = data.pop(mapping_path)
-                    map_data = cls(mapping_path).encode({mapping_path: input_data}, auto_encode)
+                    map_data = get_mapping(mapping_path).encode({mapping_path: input_data}, auto_encode)
                     data = BaseWebApi().mapping_data(data)
                     data[mapping_path] = map_data
                     return data
                 except TypeError:
-                    return cls(None).encode(data, auto_encode)
-            return cls(mapping_path).encode(data, auto_encode)
+                    return get_mapping(None).encode(data, auto_encode)
+            return get_mapping(mapping_path).encode(data, auto_encode)
+
+        def fused_json(data, get_mapping):
+            """
+            chunks of the json or None when the data needs the regular path
+            get_mapping(path) - mapping instance with the requested fieldset
+            """
+            encode = JsonEncoder(sort_keys=True, ensure_ascii=False).encode
+            if not (data and mapping_path):
+                return get_mapping(mapping_path).iter_json(data, encode, auto_encode)
+            if isinstance(data, (list, Columnar)):
+                return get_mapping(None).iter_json(data, encode, auto_encode)
+            if not isinstance(data, dict) or '.' in mapping_path or mapping_path not in data:
+                return None
+            input_data = data.pop(mapping_path)
+            other = BaseWebApi().mapping_data(data)
+            other.pop(mapping_path, None)
+            return fused_dict(other, get_mapping(mapping_path).iter_json({mapping_path: input_data}, encode,
+                                                                          auto_encode), encode)
+
+        def fused_dict(other, mapped_chunks, encode):
+            yield '{'
+            for index, key in enumerate(sorted(list(other.keys()) + [mapping_path])):
+                yield (', ' if index else '') + encode(key) + ': '
+                if key == mapping_path:
+                    for chunk in mapped_chunks:
+                        yield chunk
+                else:
+                    yield encode(other[key])
+            yield '}'
 
+        # BaseWebApi.negotiate doesn't refuse the Accept header of an export
+        _wrapped_view_func.export_formats = export_formats
         return _wrapped_view_func
 
     return decorator
@@ -103,11 +309,22 @@ class JsonEncoder(json.DjangoJSONEncoder):
             return o
         elif isinstance(o, (set, types.GeneratorType)):
             return list(o)
+        elif isinstance(o, Columnar):
+            return o.envelope()
         return super(JsonEncoder, self).default(o)
 
 
 class ResourceOptions(object):
     default_format = "application/json"
+    # media types the resource can answer with / read, None - all available
+    renderers = None
+    parsers = None
+    # None - use settings.WEB_API_SERVER_TIMING
+    server_timing = None
+    # None - use settings.WEB_API_QUERY_PROFILER
+    query_profiler = None
+    # share the response of identical concurrent GETs, None - use settings.WEB_API_COALESCE
+    coalesce = None
     method_suffix = {
         'get': '',
         'detail': '_detail',
@@ -135,6 +352,10 @@ class DeclarativeMetaclass(type):
         new_class = super(DeclarativeMetaclass, cls).__new__(cls, name, bases, attrs)
         opts = getattr(new_class, 'Meta', None)
         new_class._meta = ResourceOptions(opts)
+        # views routed by method(), {(view, http method): name of the view method}
+        new_class._meta.views = OrderedDict()
+        new_class._meta.handlers = {}
+        warmup.register('resources', new_class.warm_up)
         return new_class
 
 
@@ -149,11 +370,17 @@ class BaseWebApi(six.with_metaclass(DeclarativeMetaclass)):
 
             <body>
                 {{ data }}
+                {% if queries %}<pre>{{ queries|pprint }}</pre>{% endif %}
             </body>
         </html>
     """
 
     def method(self, view):
+        self._meta.views[view] = None
+
+        def get_callback(http_method):
+            return getattr(self, self.get_handler(view, http_method))
+
         @csrf_exempt
         def wrapper(request, *args, **kwargs):
             if request.method == "OPTIONS":
@@ -162,28 +389,72 @@ class BaseWebApi(six.with_metaclass(DeclarativeMetaclass)):
                 response['Access-Control-Allow-Headers'] = \
                     'Origin, X-Requested-With, Content-Type, Accept, Key, Authorization'
                 return response
+            if request.method == "GET" and coalesce.is_enabled(self._meta.coalesce) and \
+                    not (settings.DEBUG and 'debug' in request.GET.dict()):
+                key = coalesce.make_key(request, (self.__class__.__module__, self.__class__.__name__, view))
+                return coalesce.run(key, lambda: handle(request, *args, **kwargs))
+            return handle(request, *args, **kwargs)
+
+        def handle(request, *args, **kwargs):
+            with routing.scope():
+                return respond(request, *args, **kwargs)
+
+        def respond(request, *args, **kwargs):
+            timing.start(self._meta.server_timing)
+            profiler.start(self._meta.query_profiler)
             try:
-                convert_view = "%s%s" % (view, self._meta.method_suffix[request.method.lower()])
-                self.convert_request_data(request)
-                if hasattr(self, convert_view):
-                    callback = getattr(self, convert_view)
-                else:
-                    callback = getattr(self, view)
+                callback = get_callback(request.method.lower())
+                with timing.stage('request'):
+                    self.convert_request_data(request)
+                    request.renderer = self.negotiate(request, getattr(callback, 'export_formats', None))
                 if not callback:
                     raise exception.NotFound
-                response = callback(request, *args, **kwargs)
+                with timing.stage('view'), batch_context():
+                    response = callback(request, *args, **kwargs)
                 if settings.DEBUG and 'debug' in request.GET.dict():
+                    from django.template import Template, RequestContext
                     template = Template(self.template)
-                    html = template.render(RequestContext(request, {"data": response}))
-                    return HttpResponse(html)
-                return self.json_response(response)
+                    queries = profiler.current()
+                    html = template.render(RequestContext(request, {
+                        "data": response, "queries": queries.summary() if queries is not None else None}))
+                    response = HttpResponse(html)
+                else:
+                    with timing.stage('render'):
+                        response = self.render(response, request.renderer)
             except exception.APIException as e:
-                return self.error_response(e)
+                response = self.error_response(e)
             except Exception as e:
-                return self.server_error(e)
+                response = self.server_error(e)
+            try:
+                # raises QueryBudgetExceeded with WEB_API_QUERY_PROFILER_MODE = 'raise'
+                return profiler.finish(request, response)
+            finally:
+                timing.finish(request, response)
 
         return wrapper
 
+    @classmethod
+    def get_handler(cls, view, http_method):
+        """
+        name of the view method for the http method, resolved once per class
+        """
+        name = cls._meta.handlers.get((view, http_method))
+        if name is None:
+            convert_view = "%s%s" % (view, cls._meta.method_suffix[http_method])
+            name = cls._meta.handlers[(view, http_method)] = convert_view if hasattr(cls, convert_view) else view
+        return name
+
+    @classmethod
+    def warm_up(cls):
+        """
+        resolve the view methods of the routed views and the renderers before the first request
+        """
+        for view in list(cls._meta.views):
+            for http_method in cls._meta.method_suffix:
+                cls.get_handler(view, http_method)
+        renderers.get_renderers(cls._meta.renderers, cls._meta.default_format)
+        return len(cls._meta.views)
+
     @staticmethod
     def _error_response(error):
         return HttpResponse(error.json_info(), status=error.status_code, content_type='application/json')
@@ -210,24 +481,44 @@ class BaseWebApi(six.with_metaclass(DeclarativeMetaclass)):
             if 'CONTENT_TYPE' in request.META:
                 content_type = request.META['CONTENT_TYPE'].split(';')[0].lower()
 
-            if content_type == "application/json":
-                try:
-                    request.data = json.json.loads(request.body.decode('utf-8')) if request.body else None
-                except ValueError:
-                    raise exception.ParseError
-            elif content_type == "text/plain":
-                request.data = request.body if request.body else None
-            elif content_type == "application/x-www-form-urlencoded":
-                request.data = dict(request.POST.copy())
-            elif content_type == "multipart/form-data":
-                request.data = dict(request.POST.copy())
-                if request.files:
-                    request.data.update(request.files)
+            parser = renderers.get_parser(content_type, self._meta.parsers)
+            if parser is not None:
+                request.data = parser.parse(request)
+            elif content_type and request.body:
+                raise exception.UnsupportedMediaType(content_type)
         elif request.GET:
             request.data = request.GET.dict()
         if request.data is None:
             request.data = {}
 
+    def get_renderers(self):
+        return renderers.get_renderers(self._meta.renderers, self._meta.default_format)
+
+    def negotiate(self, request, export_formats=None):
+        """
+        renderer for the Accept header, the default one (default_format) without it and for */*,
+        NotAcceptable when none of the resource renderers fits, except for an export of the view
+        """
+        available = self.get_renderers()
+        renderer = renderers.select_renderer(request.META.get('HTTP_ACCEPT', ''), available)
+        if renderer is None and available and \
+                not (export_formats and exports.get_format(request, formats=export_formats)):
+            raise exception.NotAcceptable(available_renderers=[ii.media_type for ii in available])
+        return renderer
+
+    def render(self, data, renderer=None):
+        """
+        responses of the views (fused, streamed, exports) are kept, every response varies by Accept
+        """
+        if isinstance(data, HttpResponseBase):
+            response = data
+        elif renderer is None:
+            response = self.json_response(data)
+        else:
+            response = renderer.render(self, data)
+        patch_vary_headers(response, ('Accept',))
+        return response
+
     @staticmethod
     def error_response(error):
         return HttpResponse(error.json_info(), status=error.status_code, content_type='application/json')
@@ -243,6 +534,8 @@ class BaseWebApi(six.with_metaclass(DeclarativeMetaclass)):
             return self.mapping_item(data, **kwargs)
         elif isinstance(data, list):
             return self.mapping_list(data, **kwargs)
+        elif isinstance(data, Columnar):
+            return data.rename(camelize)
         return data
 
     def mapping_list(self, data, **kwargs):
@@ -262,37 +555,35 @@ class BaseWebApi(six.with_metaclass(DeclarativeMetaclass)):
             if kwargs and key in kwargs:
                 new_key = kwargs[key]
             else:
-                key_components = [component.title() for component in key.split('_')]
-                new_key = key_components[0].lower() + "".join(key_components[1:]) \
-                    if key_components.__len__() > 1 else key_components[0].lower()
+                new_key = camelize(key)
             if isinstance(new_key, dict):
                 new_key = new_key.get('key', 'undefined')
             if isinstance(value, dict):
                 new_item[new_key] = self.mapping_item(value, **kwargs)
             elif isinstance(value, list):
                 new_item[new_key] = self.mapping_list(value, **kwargs)
+            elif isinstance(value, Columnar):
+                new_item[new_key] = value.rename(camelize)
             else:
                 new_item[new_key] = value
         return new_item
 
     def response(self, data):
-        if self._meta.default_format == "application/json":
-            return self.json_response(data)
-        elif self._meta.default_format == "text/xml":
-            return self.xml_response(data)
-        else:
-            return data
+        for renderer in renderers.RENDERERS + renderers.EXTRA_RENDERERS:
+            if renderer.media_type == self._meta.default_format:
+                return renderer.render(self, data)
+        return data
 
-    def json_response(self, data, response_class=None):
-        if isinstance(data, HttpResponse):
+    def json_response(self, data, response_class=None, content_type=None):
+        if isinstance(data, HttpResponseBase):
             return data
         if not response_class:
             response_class = HttpResponse
         data_convert = json.json.dumps(data, cls=JsonEncoder, sort_keys=True, ensure_ascii=False)
-        return response_class(data_convert, content_type=self._meta.default_format)
+        return response_class(data_convert, content_type=content_type or self._meta.default_format)
 
     def xml_response(self, data, response_class=None):
-        if isinstance(data, HttpResponse):
+        if isinstance(data, HttpResponseBase):
             return data
         if not response_class:
             response_class = HttpResponse